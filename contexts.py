@@ -6,6 +6,8 @@ import numpy as np
 import collections
 from sklearn.cluster import KMeans
 
+from data_processing.embedding_cache import open_embedding_cache
+
 
 IGNORED_TOKENS = ['was', 'time', 'later', 'is', 'were', 'be', 'been', 'have', 'became', 'year', 'life', 'died', 'born', 'had', 'did', 'do', 'said', 'are', 'has', 'such', 'father', 'mother', 'death', 'while', 'including', 'whose', 'whom', 'known', '-', '–', "''"]
 IGNORED_POS = [',', '.', ':', '``', '(', ')', '', "''",
@@ -47,13 +49,8 @@ def read_word2vec_data(peopleNames, embeddingsFilename, extraTokens = [], numMos
             Note: chosenTokensNCounts correspond to the columns of allVectorsMat
     '''
 
-    words_with_embeddings = set()
-
-    # first pass: get available words first
-    with open(embeddingsFilename, encoding='utf8') as ifile:
-        for line in ifile.readlines():
-            token = line.split()[0]
-            words_with_embeddings.add(token)
+    # available words come from the cache's index; vectors are only read for the chosen tokens
+    words_with_embeddings = open_embedding_cache(embeddingsFilename)
 
     tokensByPerson = {}  # { person: [non-ignored tokens...] }
     noVectorTokens = set()
@@ -110,21 +107,7 @@ def read_word2vec_data(peopleNames, embeddingsFilename, extraTokens = [], numMos
         if extraToken not in [p[0] for p in chosenTokensNCounts]:
             chosenTokensNCounts.append((extraToken, 0))
 
-    tokensChosen_hash = set(p[0] for p in chosenTokensNCounts)   # for fast lookup
-
-    word2vecData = {}
-    with open(embeddingsFilename, encoding='utf8') as ifile:
-        for line in ifile.readlines():
-
-            token = line.split()[0]
-
-            if token in tokensChosen_hash:
-                try:
-                    word2vecData[token] = [float(d) for d in line.split()[1:]]
-                except:
-                    pass
-
-    del tokensChosen_hash
+    word2vecData = {p[0]: words_with_embeddings[p[0]] for p in chosenTokensNCounts if p[0] in words_with_embeddings}
 
     allVectorsMat = np.array([word2vecData[t] for t in [p[0] for p in chosenTokensNCounts]])
     extraTokensMat = np.array([word2vecData[p] for p in extraTokens])
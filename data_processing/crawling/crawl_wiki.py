@@ -1,7 +1,8 @@
-import requests
 import json
 import os
 
+from data_processing.crawling.http_cache import cached_get
+
 PPL_DATA_DIR = '../../data/peopleData'
 
 def possible_spellings_of_a_name(name_):
@@ -32,7 +33,7 @@ def crawl_wiki_text(name_, outputDir_, skipIfExists_):
     for curName in possible_spellings_of_a_name(name_):
 
         url = 'https://en.wikipedia.org/w/api.php?action=query&format=json&prop=extracts&meta=&titles=' + curName.replace(' ', '+') + '&redirects=1'
-        t = requests.get(url)
+        t = cached_get(url)
         fullD = json.loads(str(t.content, 'utf-8'))
 
         extract = list(fullD['query']['pages'].items())[0][1].get('extract', None)
@@ -1,6 +1,9 @@
 import json
 import glob
 import os
+import tempfile
+from time import time
+from html.parser import HTMLParser
 import bs4
 from bs4 import BeautifulSoup
 from joblib import Parallel, delayed
@@ -8,6 +11,7 @@ import multiprocessing
 
 
 from data_processing.crawling.crawl_wiki import crawl_wiki_text
+from data_processing.crawling.wiki_fetcher import WikiFetcher
 
 
 # in order of search
@@ -98,6 +102,177 @@ def extract_early_life(filename_, outputFilename_, skipIfExists_):
     return earlyLifeContent
 
 
+# tags that never have content or an end tag
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+class _EarlyLifeParser(HTMLParser):
+    """
+    Single pass over the HTML events, keeping only the text of the current top-level element.
+    Same section rules as extract_early_life: the first top-level heading that contains one of EARLY_LIFE_STRINGS
+    (and not 'career') starts the section, which runs until the next heading of the same or a higher level.
+    """
+
+    def __init__(self, filename_, outputFilename_):
+        super().__init__(convert_charrefs=True)
+
+        self.filename = filename_
+        self.outputFilename = outputFilename_
+        self.earlyLifeContent = []
+        self.done = False
+
+        self._openTags = []         # stack of open tag names; empty at the top level
+        self._topName = None        # name of the current top-level element; None for top-level text
+        self._topText = []
+        self._sectionHeading = None  # name of the heading whose section is being collected
+
+    # ------- HTML events -------
+    def handle_starttag(self, tag, attrs):
+        if not self._openTags:
+            self._topName = tag
+            self._topText = []
+
+        if tag in VOID_TAGS:
+            if not self._openTags: self._on_top_level(tag, '')
+        else:
+            self._openTags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self._openTags:
+            self._on_top_level(tag, '')
+
+    def handle_endtag(self, tag):
+        if tag not in self._openTags: return   # stray end tag
+
+        while self._openTags.pop() != tag: pass
+
+        if not self._openTags:
+            self._on_top_level(self._topName, ''.join(self._topText))
+
+    def handle_data(self, data):
+        if self._openTags:
+            self._topText.append(data)
+        else:
+            self._on_top_level(None, data)
+
+    handle_comment = handle_data
+
+    def close(self):
+        super().close()
+
+        # unclosed top-level element, then the end of the document closes any open section
+        if self._openTags:
+            self._openTags = []
+            self._on_top_level(self._topName, ''.join(self._topText))
+
+        if self._sectionHeading is not None:
+            self._end_section()
+
+    # ------- section logic -------
+    def _on_top_level(self, name, text):
+        if self.done: return
+
+        if self._sectionHeading is not None:
+            if name is None or name[0] != 'h' or self._sectionHeading[1] < name[1]:
+                self._collect(name, text.strip())
+                return
+
+            self._end_section()
+            if self.done: return
+
+        if name and name[0] == 'h':
+            heading = text.lower()
+
+            for earlyLifeString in EARLY_LIFE_STRINGS:
+                if earlyLifeString.lower() in heading and heading.find('career')==-1:
+                    print('found for %s:' % self.filename, earlyLifeString, 'in', heading)
+                    self._sectionHeading = name
+                    break
+
+    def _collect(self, name, curContent):
+        if not curContent: return
+
+        # start a new "paragraph" if it's a p or blockquote
+        if name in ['p', 'blockquote'] or (name and name[0] == 'h') or len(self.earlyLifeContent) == 0:
+            self.earlyLifeContent.append(curContent)
+        else:
+            self.earlyLifeContent[-1] += curContent
+
+    def _end_section(self):
+        self._sectionHeading = None
+
+        with open(self.outputFilename, 'w', encoding='utf-8') as outputFile:
+            outputFile.writelines('\n'.join(self.earlyLifeContent))
+
+        self.done = len(self.earlyLifeContent) > 0
+
+
+def extract_early_life_streaming(filename_, outputFilename_, skipIfExists_, chunkSize_=64*1024):
+    """
+    a faster extract_early_life: reads the file in chunks and stops as soon as the early life section is complete
+    """
+
+    if skipIfExists_ and os.path.exists(outputFilename_):
+        print(outputFilename_, 'already exists. Skipping...')
+
+        with open(outputFilename_, encoding='utf8') as file:
+            res = file.readlines()
+        return res
+
+    parser = _EarlyLifeParser(filename_, outputFilename_)
+
+    with open(filename_, encoding='UTF-8') as inputFile:
+        for chunk in iter(lambda: inputFile.read(chunkSize_), ''):
+            parser.feed(chunk)
+
+            if parser.done: break
+
+    parser.close()
+
+    if not parser.earlyLifeContent:
+        print(filename_, 'does not have early life.')
+
+    return parser.earlyLifeContent
+
+
+def benchmark_early_life_extraction(inputFilenames_):
+    """
+    throughput of the streaming extractor vs. the BeautifulSoup one, and whether their outputs agree
+    :return: list of files whose outputs differ
+    """
+
+    timings = {}
+    outputDirs = {}
+
+    for extractor in [extract_early_life, extract_early_life_streaming]:
+        outputDir = outputDirs[extractor.__name__] = tempfile.mkdtemp()
+
+        st = time()
+        for filename in inputFilenames_:
+            extractor(filename, os.path.join(outputDir, os.path.basename(filename)), skipIfExists_=False)
+        timings[extractor.__name__] = time() - st
+
+    mismatches = []
+
+    for filename in inputFilenames_:
+        outputs = []
+
+        for outputDir in outputDirs.values():
+            outputFilename = os.path.join(outputDir, os.path.basename(filename))
+
+            with open(outputFilename, encoding='utf8') if os.path.exists(outputFilename) else open(os.devnull) as ifile:
+                outputs.append(ifile.read())
+
+        if outputs[0] != outputs[1]:
+            mismatches.append(filename)
+
+    for name, t in timings.items():
+        print('%-30s %0.3f s, %0.1f files/s' % (name, t, len(inputFilenames_) / t if t else float('inf')))
+    print('%d out of %d outputs differ.' % (len(mismatches), len(inputFilenames_)))
+
+    return mismatches
+
+
 def name_to_earlylife(name,
                       extractsDir_ = os.path.join(PPL_DATA_DIR, 'extracts'),
                       outputDir_ = os.path.join(PPL_DATA_DIR, 'earlyLifesTexts'),
@@ -114,7 +289,34 @@ def name_to_earlylife(name,
     if temp is None:
         return None
 
-    return extract_early_life(temp[1], finalOutputFname, skipIfFilesExists_)
+    return extract_early_life_streaming(temp[1], finalOutputFname, skipIfFilesExists_)
+
+
+def names_to_earlylifes(names_,
+                        extractsDir_ = os.path.join(PPL_DATA_DIR, 'extracts'),
+                        outputDir_ = os.path.join(PPL_DATA_DIR, 'earlyLifesTexts'),
+                        skipIfFilesExists_=True, fetcher_=None):
+    """
+    name_to_earlylife for many names: extracts are fetched concurrently over one pooled, rate-limited session,
+    then early lifes are extracted in parallel processes
+    :type fetcher_: WikiFetcher
+    """
+
+    todo = [name for name in names_
+            if not (skipIfFilesExists_ and os.path.exists(os.path.join(outputDir_, name + '.txt')))]
+    print('%d of %d early lifes already exist.' % (len(names_) - len(todo), len(names_)))
+
+    crawled = (fetcher_ or WikiFetcher()).crawl_wiki_texts(todo, extractsDir_, skipIfFilesExists_)
+
+    def process_one_person(name_, extractFilename_):
+        try:
+            return extract_early_life_streaming(extractFilename_, os.path.join(outputDir_, name_ + '.txt'), skipIfFilesExists_)
+        except Exception as e:
+            print('Error occurred:', e)
+
+    numCores = multiprocessing.cpu_count() - 1
+    return Parallel(n_jobs=numCores)(delayed(process_one_person)(name, c[1])
+                                     for name, c in crawled.items() if c is not None)
 
 
 if __name__ == '__main__':
@@ -141,14 +343,6 @@ if __name__ == '__main__':
         with open(filename, encoding='utf8') as ifile:
             peopleData.update(json.load(ifile))
 
-    def process_one_person(name_):
-        try:
-            name_to_earlylife(name_,
-                              outputDir_ = os.path.join(PPL_DATA_DIR, 'earlyLifesTexts'))
-        except Exception as e:
-            print('Error occurred:', e)
-
-    numCores = multiprocessing.cpu_count() - 1
-    Parallel(n_jobs=numCores)(delayed(process_one_person)(name) for name in peopleData.keys())
-
+    names_to_earlylifes(list(peopleData.keys()))
 
+    # benchmark_early_life_extraction(glob.glob(os.path.join(PPL_DATA_DIR, 'extracts', '*.txt')))
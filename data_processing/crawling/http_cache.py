@@ -0,0 +1,215 @@
+import os, glob, json
+import hashlib
+import tempfile
+import threading
+from time import time
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+HTTP_CACHE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../../data/httpCache')
+
+
+class HttpCache(object):
+    """
+    On-disk cache of GET responses, keyed by a hash of the URL and request params.
+    Fresh entries (younger than ttlSeconds) are served without touching the network; stale ones are revalidated
+    with If-None-Match / If-Modified-Since. The least recently used entries are evicted beyond maxBytes.
+    """
+
+    def __init__(self, cacheDir=HTTP_CACHE_DIR, ttlSeconds=30*24*3600, maxBytes=2*1024**3):
+
+        self.cacheDir = cacheDir
+        self.ttlSeconds = ttlSeconds
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+
+        if not os.path.exists(cacheDir): os.makedirs(cacheDir)
+
+        self.totalBytes = sum(os.path.getsize(f) for f in glob.glob(os.path.join(cacheDir, '*.body')))
+
+        self.numHits = 0
+        self.numRevalidated = 0
+        self.numMisses = 0
+
+    @staticmethod
+    def key(url_, params_=None):
+        return hashlib.sha256(json.dumps([url_, sorted((params_ or {}).items())]).encode('utf8')).hexdigest()
+
+    def _paths(self, key_):
+        return os.path.join(self.cacheDir, key_ + '.body'), os.path.join(self.cacheDir, key_ + '.json')
+
+    def _load(self, key_):
+        """
+        :return: (meta, body), or None if not cached
+        """
+
+        bodyPath, metaPath = self._paths(key_)
+
+        try:
+            with open(metaPath, encoding='utf8') as ifile:
+                meta = json.load(ifile)
+
+            with open(bodyPath, 'rb') as ifile:
+                body = ifile.read()
+
+            os.utime(bodyPath)  # mtime of the body = last use, for LRU eviction
+        except (IOError, ValueError):   # also an entry evicted meanwhile: a miss
+            return None
+
+        return meta, body
+
+    def _store(self, key_, url_, response_):
+        bodyPath, metaPath = self._paths(key_)
+        oldSize = os.path.getsize(bodyPath) if os.path.exists(bodyPath) else 0
+
+        meta = {'url': url_, 'fetchedAt': time(), 'status': response_.status_code,
+                'headers': {k: v for k, v in response_.headers.items()
+                            if k.lower() in ['etag', 'last-modified', 'content-type']}}
+
+        self._write(bodyPath, response_.content)
+        self._write(metaPath, json.dumps(meta).encode('utf8'))
+
+        with self._lock:
+            self.totalBytes += len(response_.content) - oldSize
+
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+
+    def _write(self, path_, data_):
+        """
+        write to a temp file of its own and rename it: threads storing the same key at once must not share one
+        """
+
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.cacheDir)
+
+        try:
+            with os.fdopen(fd, 'wb') as ofile:
+                ofile.write(data_)
+
+            os.replace(tmpPath, path_)
+        except BaseException:
+            if os.path.exists(tmpPath): os.remove(tmpPath)
+            raise
+
+    def _count(self, counterName_):
+        with self._lock:
+            setattr(self, counterName_, getattr(self, counterName_) + 1)
+
+    def _touch(self, key_, meta_):
+        meta_['fetchedAt'] = time()
+        _, metaPath = self._paths(key_)
+
+        self._write(metaPath, json.dumps(meta_).encode('utf8'))
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache is at 90% of maxBytes
+        """
+
+        with self._lock:
+            bodies = sorted(glob.glob(os.path.join(self.cacheDir, '*.body')), key=os.path.getmtime)
+
+            for bodyPath in bodies:
+                if self.totalBytes <= 0.9 * self.maxBytes: break
+
+                size = os.path.getsize(bodyPath)
+
+                for path in [bodyPath, bodyPath[:-len('.body')] + '.json']:
+                    if os.path.exists(path): os.remove(path)
+
+                self.totalBytes -= size
+
+    @staticmethod
+    def _make_response(url_, meta_, body_):
+        res = requests.Response()
+        res.url = url_
+        res.status_code = meta_['status']
+        res.headers = CaseInsensitiveDict(meta_['headers'])
+        res._content = body_
+
+        return res
+
+    def get(self, session_, url_, params=None, beforeRequest=None, **kwargs):
+        """
+        drop-in for session_.get(url_, params=params, **kwargs). Only 200 responses are cached.
+        :type session_: requests.Session
+        :param beforeRequest: called right before going to the network (e.g. a rate limiter's wait), not on cache hits
+        :return: requests.Response
+        """
+
+        if beforeRequest is None: beforeRequest = lambda: None
+
+        key = self.key(url_, params)
+        cached = self._load(key)
+
+        if cached is not None:
+            meta, body = cached
+
+            if time() - meta['fetchedAt'] < self.ttlSeconds:
+                self._count('numHits')
+                return self._make_response(url_, meta, body)
+
+            # stale: ask the server whether it changed
+            cachedHeaders = CaseInsensitiveDict(meta['headers'])
+            conditions = {}
+            if 'etag' in cachedHeaders: conditions['If-None-Match'] = cachedHeaders['etag']
+            if 'last-modified' in cachedHeaders: conditions['If-Modified-Since'] = cachedHeaders['last-modified']
+
+            if conditions:
+                headers = dict(kwargs.pop('headers', None) or {}, **conditions)
+                beforeRequest()
+                response = session_.get(url_, params=params, headers=headers, **kwargs)
+
+                if response.status_code == 304:
+                    self._count('numRevalidated')
+                    self._touch(key, meta)
+                    return self._make_response(url_, meta, body)
+            else:
+                beforeRequest()
+                response = session_.get(url_, params=params, **kwargs)
+        else:
+            beforeRequest()
+            response = session_.get(url_, params=params, **kwargs)
+
+        self._count('numMisses')
+
+        if response.status_code == 200:
+            self._store(key, url_, response)
+
+        return response
+
+    def stats(self):
+        with self._lock:
+            return '%d hits, %d revalidated, %d misses; %0.1f MB cached' \
+                   % (self.numHits, self.numRevalidated, self.numMisses, self.totalBytes / 1024**2)
+
+
+_sharedCache = None
+_sharedSession = None
+
+
+def shared_cache():
+    """
+    :return: the HttpCache used by all crawling modules
+    """
+
+    global _sharedCache
+
+    if _sharedCache is None:
+        _sharedCache = HttpCache()
+
+    return _sharedCache
+
+
+def cached_get(url_, params=None, **kwargs):
+    """
+    requests.get through the shared cache and one shared session
+    """
+
+    global _sharedSession
+
+    if _sharedSession is None:
+        _sharedSession = requests.Session()
+
+    return shared_cache().get(_sharedSession, url_, params=params, **kwargs)
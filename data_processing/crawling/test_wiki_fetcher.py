@@ -0,0 +1,108 @@
+import os, json
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from data_processing.crawling.http_cache import HttpCache
+from data_processing.crawling.wiki_fetcher import WikiFetcher
+
+
+# a tiny MediaWiki: existing pages, one redirect, and titles whose queries fail with HTTP 500
+STUB_PAGES = {'Ada Lovelace': 'Ada was born in London.', 'Alan Turing': 'Alan was born in Maida Vale.',
+              'Bad Extract': 'never served'}
+STUB_REDIRECTS = {'Alan turing': 'Alan Turing'}
+STUB_BROKEN_TITLES = {'broken name'}
+STUB_BROKEN_EXTRACTS = {'Bad Extract'}
+
+
+def start_stub_wiki():
+    """
+    :return: (server, api url, list of the titles= param of every request). Call server.shutdown() when done.
+    """
+
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            titles = params.get('titles', '').split('|')
+            requested.append(params.get('titles', ''))
+
+            if set(titles) & STUB_BROKEN_TITLES or (params.get('prop') == 'extracts' and set(titles) & STUB_BROKEN_EXTRACTS):
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            redirects = [{'from': t, 'to': STUB_REDIRECTS[t]} for t in titles if t in STUB_REDIRECTS]
+            pages = {}
+
+            for i, t in enumerate(STUB_REDIRECTS.get(t, t) for t in titles):
+                pages[str(i + 1) if t in STUB_PAGES else str(-i - 1)] = \
+                    dict({'title': t}, **({'extract': STUB_PAGES[t]} if params.get('prop') == 'extracts' else {})) \
+                    if t in STUB_PAGES else {'title': t, 'missing': ''}
+
+            body = json.dumps({'query': {'redirects': redirects, 'pages': pages}}).encode('utf8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:%d/w/api.php' % server.server_address[1], requested
+
+
+def test_crawl_wiki_texts_against_stub():
+    server, apiUrl, requested = start_stub_wiki()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            outputDir = os.path.join(tmpDir, 'extracts')
+            os.makedirs(outputDir)
+
+            fetcher = WikiFetcher(apiUrl, maxRequestsPerSecond=1000, numThreads=4, numRetries=1, backoffSeconds=0.,
+                                  httpCache=HttpCache(os.path.join(tmpDir, 'httpCache')))
+            names = ['ada lovelace', 'alan turing', 'broken name', 'bad extract']
+
+            res = fetcher.crawl_wiki_texts(names, outputDir, skipIfExists_=True)
+
+            # the same layout as crawl_wiki_text: <outputDir>/<name>.txt with the extract
+            for name, page in [('ada lovelace', 'Ada Lovelace'), ('alan turing', 'Alan Turing')]:
+                extract, outputFilename = res[name]
+                assert extract == STUB_PAGES[page]
+                assert outputFilename == os.path.join(outputDir, name + '.txt')
+
+                with open(outputFilename, encoding='utf8') as ifile:
+                    assert ifile.read() == STUB_PAGES[page]
+
+            # failures only lose their own names
+            assert res['broken name'] is None and res['bad extract'] is None
+            assert sorted(os.listdir(outputDir)) == ['ada lovelace.txt', 'alan turing.txt']
+
+            # all spellings were resolved in one batched query before falling back to one title per query
+            assert len(requested[0].split('|')) == len(set(s for n in names for s in fetcher_spellings(n)))
+
+            # a rerun is served from the files and the HTTP cache
+            numRequests = len(requested)
+            assert fetcher.crawl_wiki_texts(names[:2], outputDir, skipIfExists_=True)['ada lovelace'][1].endswith('ada lovelace.txt')
+            assert len(requested) == numRequests
+    finally:
+        server.shutdown()
+
+
+def fetcher_spellings(name_):
+    from data_processing.crawling.crawl_wiki import possible_spellings_of_a_name
+    return possible_spellings_of_a_name(name_)
+
+
+if __name__ == '__main__':
+    test_crawl_wiki_texts_against_stub()
+    print('OK')
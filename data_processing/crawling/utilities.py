@@ -1,6 +1,6 @@
 import re
 from data_processing.file2vec import ZERO_WIDTH_UNICODES
-import requests
+from data_processing.crawling.http_cache import cached_get
 from pprint import pprint
 import os, json
 from bs4 import BeautifulSoup
@@ -49,7 +49,7 @@ def clean_line(line_):  # strip and remove stuff, lower case
     return res
 
 def url_2_soup(url):
-    return BeautifulSoup(requests.get(url).content, 'html.parser')
+    return BeautifulSoup(cached_get(url).content, 'html.parser')
 
 def is_not_name(s_):
     """ 
@@ -0,0 +1,221 @@
+import os, json
+import threading
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+from data_processing.crawling.crawl_wiki import possible_spellings_of_a_name
+from data_processing.crawling.http_cache import shared_cache
+
+
+WIKI_API_URL = 'https://en.wikipedia.org/w/api.php'
+MAX_TITLES_PER_QUERY = 50   # MediaWiki's limit for titles=a|b|c
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+PPL_DATA_DIR = '../../data/peopleData'
+
+
+class RateLimiter(object):
+    """
+    at most maxPerSecond calls to wait() return per second, across all threads
+    """
+
+    def __init__(self, maxPerSecond):
+        assert maxPerSecond > 0
+
+        self.interval = 1. / maxPerSecond
+        self._lock = threading.Lock()
+        self._nextTime = 0.
+
+    def wait(self):
+        with self._lock:
+            now = time()
+            waitFor = self._nextTime - now
+            self._nextTime = max(now, self._nextTime) + self.interval
+
+        if waitFor > 0: sleep(waitFor)
+
+
+class WikiFetcher(object):
+    """
+    Fetches Wikipedia extracts over one pooled HTTP session, with a global rate limit and retries with backoff.
+    Name spellings are resolved MAX_TITLES_PER_QUERY at a time. Full-page extracts are then fetched one page
+    per request, since the TextExtracts API returns only one full extract per query.
+    """
+
+    def __init__(self, apiUrl=WIKI_API_URL, maxRequestsPerSecond=10, numThreads=8,
+                 numRetries=4, backoffSeconds=1., timeoutSeconds=30, httpCache=None):
+        """
+        :param httpCache: HttpCache for the responses; None for the shared one
+        """
+
+        self.apiUrl = apiUrl
+        self.numThreads = numThreads
+        self.numRetries = numRetries
+        self.backoffSeconds = backoffSeconds
+        self.timeoutSeconds = timeoutSeconds
+        self.rateLimiter = RateLimiter(maxRequestsPerSecond)
+        self.httpCache = httpCache or shared_cache()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=numThreads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._countLock = threading.Lock()
+        self.numRequests = 0
+        self.numRetried = 0
+
+    def _count(self, counterName_):
+        with self._countLock:
+            setattr(self, counterName_, getattr(self, counterName_) + 1)
+
+    def query(self, **params):
+        """
+        one API call (action=query, format=json), retried with exponential backoff on connection errors and 429/5xx
+        :return: the decoded JSON response
+        """
+
+        params = dict(action='query', format='json', **params)
+
+        for attempt in range(self.numRetries + 1):
+            self._count('numRequests')
+
+            try:
+                response = self.httpCache.get(self.session, self.apiUrl, params=params,
+                                              beforeRequest=self.rateLimiter.wait, timeout=self.timeoutSeconds)
+
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return json.loads(str(response.content, 'utf-8'))
+
+                retryAfter = response.headers.get('Retry-After')
+                error = 'HTTP %d' % response.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retryAfter = None
+                error = str(e)
+
+            if attempt == self.numRetries:
+                raise IOError('Giving up on %s after %d attempts: %s' % (params, attempt + 1, error))
+
+            self._count('numRetried')
+            sleep(float(retryAfter) if retryAfter and retryAfter.isdigit() else self.backoffSeconds * 2 ** attempt)
+
+    def resolve_titles(self, titles_):
+        """
+        follow normalizations and redirects, MAX_TITLES_PER_QUERY titles per request.
+        If a batch fails, its titles are resolved one by one, so one bad title only loses itself.
+        :return: { requested title: existing page title, or None if there is no such page (or it could not be resolved) }
+        """
+
+        res = {}
+        titles_ = list(dict.fromkeys(titles_))  # unique, in order
+
+        for start in range(0, len(titles_), MAX_TITLES_PER_QUERY):
+            batch = titles_[start:(start + MAX_TITLES_PER_QUERY)]
+
+            try:
+                res.update(self._resolve_batch(batch))
+            except Exception as e:
+                print('Resolving %d titles failed (%s: %s). Resolving them one by one...' % (len(batch), e.__class__.__name__, e))
+
+                for title in batch:
+                    try:
+                        res.update(self._resolve_batch([title]))
+                    except Exception as e:
+                        print('ERROR: could not resolve %s: %s: %s' % (title, e.__class__.__name__, e))
+                        res[title] = None
+
+        return res
+
+    def _resolve_batch(self, batch_):
+        res = {}
+        q = self.query(titles='|'.join(batch_), redirects=1)['query']
+
+        mapping = {d['from']: d['to'] for d in q.get('normalized', [])}
+        redirects = {d['from']: d['to'] for d in q.get('redirects', [])}
+        existing = {p['title'] for p in q.get('pages', {}).values() if 'missing' not in p and 'invalid' not in p}
+
+        for title in batch_:
+            final = mapping.get(title, title)
+            final = redirects.get(final, final)
+            res[title] = final if final in existing else None
+
+        return res
+
+    def fetch_extract(self, pageTitle_):
+        """
+        :return: the page's extract, or None
+        """
+
+        pages = self.query(prop='extracts', titles=pageTitle_, redirects=1)['query'].get('pages', {})
+
+        return next(iter(pages.values()), {}).get('extract', None)
+
+    def crawl_wiki_texts(self, names_, outputDir_, skipIfExists_):
+        """
+        the batched equivalent of crawl_wiki_text; writes the same outputDir_/<name>.txt files
+        :return: { name: (extract, output filename) if successful; otherwise, None }
+        """
+
+        res = {}
+        todo = []
+
+        for name in names_:
+            outputFilename = os.path.join(outputDir_, name + '.txt')
+
+            if skipIfExists_ and os.path.exists(outputFilename):
+                with open(outputFilename, encoding='utf8') as file:
+                    res[name] = file.readlines(), outputFilename
+            else:
+                todo.append(name)
+
+        print('%d of %d names already crawled. Fetching %d...' % (len(res), len(names_), len(todo)))
+
+        spellings = {name: possible_spellings_of_a_name(name) for name in todo}
+        pageTitles = self.resolve_titles([s for ss in spellings.values() for s in ss])
+
+        def _crawl_one(name):
+            # an error only loses this name; the rest of the crawl goes on
+            try:
+                return _fetch_one(name)
+            except Exception as e:
+                print('ERROR: crawling %s failed: %s: %s. Skipping...' % (name, e.__class__.__name__, e))
+                return None
+
+        def _fetch_one(name):
+            # try the spellings that exist, in the same order as crawl_wiki_text
+            for pageTitle in dict.fromkeys(pageTitles[s] for s in spellings[name] if pageTitles[s]):
+                extract = self.fetch_extract(pageTitle)
+
+                if extract is not None:
+                    outputFilename = os.path.join(outputDir_, name + '.txt')
+
+                    with open(outputFilename, 'w', encoding='utf-8') as ofile:
+                        ofile.writelines(extract)
+
+                    return extract, outputFilename
+
+            print('extract does not exist for %s. quitting...' % name)
+            return None
+
+        with ThreadPoolExecutor(self.numThreads) as executor:
+            res.update(zip(todo, executor.map(_crawl_one, todo)))
+
+        print('%d queries made, %d retried. HTTP cache: %s' % (self.numRequests, self.numRetried, self.httpCache.stats()))
+
+        return res
+
+
+if __name__ == '__main__':
+
+    inputFileName = os.path.join(PPL_DATA_DIR, 'processed_names', 'nobel_prize_processed_names.json')
+    outputDir = os.path.join(PPL_DATA_DIR, 'extracts', 'nobelprizeextracts')
+
+    with open(inputFileName, encoding='utf8') as namesFiles:
+        names = list(json.load(namesFiles).keys())
+
+    results = WikiFetcher().crawl_wiki_texts(names, outputDir, skipIfExists_=True)
+
+    print(sum(r is not None for r in results.values()), ' out of ', len(names), ' processed successfully.')
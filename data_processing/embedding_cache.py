@@ -0,0 +1,182 @@
+import os, sys
+import json
+import numpy as np
+
+
+VECTORS_FILENAME = 'vectors.f32'
+VOCAB_FILENAME = 'vocab.txt'
+META_FILENAME = 'meta.json'
+
+
+def cache_dir_for(embeddingsFilename_):
+    return embeddingsFilename_ + '.cache'
+
+
+def _source_signature(embeddingsFilename_):
+    st = os.stat(embeddingsFilename_)
+    return {'source': os.path.abspath(embeddingsFilename_), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+def build_embedding_cache(embeddingsFilename_, cacheDir_=None, chunkSize_=10000):
+    """
+    One-time conversion of a text embeddings file (word v1 v2 ...) into a vocab file plus an (N x D) float32 buffer.
+    The text file is streamed in chunks, so memory stays at one chunk no matter how large the file is.
+    :return: cache directory
+    """
+
+    cacheDir_ = cacheDir_ or cache_dir_for(embeddingsFilename_)
+    if not os.path.exists(cacheDir_): os.makedirs(cacheDir_)
+
+    print('Building embedding cache for %s in %s...' % (embeddingsFilename_, cacheDir_))
+
+    metaFilename = os.path.join(cacheDir_, META_FILENAME)
+    if os.path.exists(metaFilename): os.remove(metaFilename)
+
+    vecDim = None
+    numRows = 0
+    numBad = 0
+    words = []
+    vecs = []
+
+    vectorsFilename = os.path.join(cacheDir_, VECTORS_FILENAME)
+    vocabFilename = os.path.join(cacheDir_, VOCAB_FILENAME)
+
+    def _flush():
+        if vecs: np.stack(vecs).tofile(vectorsFile)
+        vocabFile.writelines(w + '\n' for w in words)
+        del words[:], vecs[:]
+
+    with open(embeddingsFilename_, encoding='utf8') as ifile, \
+            open(vectorsFilename + '.tmp', 'wb') as vectorsFile, \
+            open(vocabFilename + '.tmp', 'w', encoding='utf8', newline='\n') as vocabFile:
+
+        for line in ifile:
+            tokens = line.rstrip().split(' ')
+            vecDim = vecDim or len(tokens) - 1
+
+            # a few lines in the big GloVe files have words with spaces or unparseable numbers
+            if len(tokens) != vecDim + 1:
+                numBad += 1
+                continue
+
+            try:
+                vecs.append(np.array(tokens[1:], dtype=np.float32))
+            except ValueError:
+                numBad += 1
+                continue
+
+            words.append(tokens[0])
+            numRows += 1
+
+            if len(words) >= chunkSize_: _flush()
+
+        _flush()
+
+    os.replace(vectorsFilename + '.tmp', vectorsFilename)
+    os.replace(vocabFilename + '.tmp', vocabFilename)
+
+    # written last: a cache without meta is rebuilt
+    with open(metaFilename, 'w', encoding='utf8') as ofile:
+        json.dump(dict(_source_signature(embeddingsFilename_), numRows=numRows, vecDim=vecDim), ofile)
+
+    print('Cached %d vectors of dimension %d; %d unparseable lines skipped.' % (numRows, vecDim, numBad))
+
+    return cacheDir_
+
+
+class EmbeddingCache(object):
+    """
+    Read-only, dict-like view of a cached embedding. Vectors stay on disk (memory-mapped) until they are looked up.
+    """
+
+    def __init__(self, cacheDir_):
+
+        with open(os.path.join(cacheDir_, META_FILENAME), encoding='utf8') as ifile:
+            self.meta = json.load(ifile)
+
+        self.vecDim = self.meta['vecDim']
+        self.vectors = np.memmap(os.path.join(cacheDir_, VECTORS_FILENAME), dtype=np.float32, mode='r',
+                                 shape=(self.meta['numRows'], self.vecDim))
+
+        # word -> row. Later duplicates win, just like filling a dict line by line.
+        with open(os.path.join(cacheDir_, VOCAB_FILENAME), encoding='utf8', newline='\n') as ifile:
+            self.index = {line[:-1]: i for i, line in enumerate(ifile)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def __getitem__(self, token):
+        return self.vectors[self.index[token]]
+
+    def get(self, token, default=None):
+        i = self.index.get(token)
+        return default if i is None else self.vectors[i]
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        for token, i in self.index.items():
+            yield token, self.vectors[i]
+
+    def lookup(self, tokens_, default=None):
+        """
+        :param default: vector for tokens that are not in the cache. If None, they are dropped.
+        :return: (len(tokens) x vecDim) float32 matrix, set of tokens not found
+        """
+
+        rows = [self.index.get(t) for t in tokens_]
+        notFound = {t for t, r in zip(tokens_, rows) if r is None}
+
+        if default is None:
+            return self.vectors[[r for r in rows if r is not None]], notFound
+
+        res = np.empty((len(rows), self.vecDim), dtype=np.float32)
+        found = np.array([r is not None for r in rows], dtype=bool)
+        res[found] = self.vectors[[r for r in rows if r is not None]]
+        res[~found] = default
+
+        return res, notFound
+
+
+_openCaches = {}     # cache dir -> EmbeddingCache, so that the vocab index is built once per process
+
+
+def open_embedding_cache(embeddingsFilename_):
+    """
+    The result is shared within a process: forked workers (e.g. a Pool created after the parent opened the file)
+    inherit it instead of rebuilding the vocab index.
+    :return: an EmbeddingCache for the file, building (or rebuilding, if the source file changed) the cache first
+    """
+
+    cacheDir = cache_dir_for(embeddingsFilename_)
+    signature = {k: v for k, v in _source_signature(embeddingsFilename_).items() if k != 'source'}
+    cache = _openCaches.get(cacheDir)
+
+    if cache is not None and all(cache.meta.get(k) == v for k, v in signature.items()):
+        return cache
+
+    metaFilename = os.path.join(cacheDir, META_FILENAME)
+    isStale = True
+
+    if os.path.exists(metaFilename):
+        with open(metaFilename, encoding='utf8') as ifile:
+            meta = json.load(ifile)
+
+        isStale = any(meta.get(k) != v for k, v in signature.items())
+
+    if isStale:
+        build_embedding_cache(embeddingsFilename_, cacheDir)
+
+    _openCaches[cacheDir] = EmbeddingCache(cacheDir)
+
+    return _openCaches[cacheDir]
+
+
+if __name__ == '__main__':
+    # usage: python embedding_cache.py ../data/glove/glove.840B.300d.txt ...
+    for filename in sys.argv[1:]:
+        open_embedding_cache(filename)
@@ -0,0 +1,133 @@
+import os, glob
+import numpy as np
+
+from data_processing.file2vec import PPL_DATA_DIR, EMBEDDINGS_FILENAMES, \
+    iter_file_tokens, extract_embedding, select_people_evenly
+
+
+IDS_FILENAME = 'ids.i32'
+IDS_INDEX_FILENAME = 'ids_index.npz'
+VOCAB_FILENAME = 'vocab.txt'
+PADDING_ID = 0  # row 0 of every embedding table is all zeros, so padded steps look the same as in patch_arrays
+
+
+def table_filename(embeddings_filekey_):
+    return 'table_%s.npy' % embeddings_filekey_
+
+
+def is_token_ids(dir_):
+    return os.path.exists(os.path.join(dir_, IDS_INDEX_FILENAME))
+
+
+def file2ids(filename, vocab_):
+    """
+    :param vocab_: { token: id }. Unseen tokens are added to it.
+    :return: 1D int32 array of token ids
+    """
+
+    return np.array([vocab_.setdefault(token, len(vocab_)) for token in iter_file_tokens(filename)], dtype=np.int32)
+
+
+def make_embedding_table(idsDir_, embeddings_filekey_):
+    """
+    Build the (vocab size x vector dim) float32 table of an embedding for an existing token-ID corpus.
+    Swapping embeddings only needs this, not a re-run of file2ids_mass.
+    Tokens missing from the embedding get its 'unk' vector, just like file2vec.
+    """
+
+    with open(os.path.join(idsDir_, VOCAB_FILENAME), encoding='utf8') as ifile:
+        vocab = [line.rstrip('\n') for line in ifile]
+
+    embeddings, notFound = extract_embedding(
+        embeddingsFilename_=EMBEDDINGS_FILENAMES[embeddings_filekey_],
+        relevantTokens_=set(vocab[PADDING_ID+1:]),
+        includeUnk_=True,
+        verbose=False
+    )
+
+    assert 'unk' in embeddings, "The %s embedding (%s) has no 'unk' token for the %d tokens missing from it." \
+                                % (embeddings_filekey_, EMBEDDINGS_FILENAMES[embeddings_filekey_], len(notFound) - 1)
+
+    unk = embeddings['unk']
+    table = np.zeros((len(vocab), len(unk)), dtype=np.float32)
+
+    for i, token in enumerate(vocab[PADDING_ID+1:], PADDING_ID+1):
+        table[i] = embeddings.get(token, unk)
+
+    outputFilename = os.path.join(idsDir_, table_filename(embeddings_filekey_))
+    np.save(outputFilename, table)
+    print('Saved %d x %d embedding table to %s.' % (*table.shape, outputFilename))
+
+    return table
+
+
+def file2ids_mass(embeddings_filekeys_=('42B300d',),
+                  occs_to_skip={'explorer', 'religion', 'royalty', 'social'}):
+    """
+    like file2vec_mass, but stores int32 token ids per person plus one deduplicated embedding table per embedding
+    :return: output directory
+    """
+
+    outputDir_ = os.path.join(PPL_DATA_DIR, 'earlyLifesTokenIds')
+
+    if not os.path.exists(outputDir_): os.mkdir(outputDir_)
+    inputFiles = glob.glob(os.path.join(PPL_DATA_DIR, 'earlyLifesTexts/*.txt'))
+
+    vocab = {'': PADDING_ID}
+    offsets = []
+    lengths = []
+    labels = []
+    names = []
+    numIds = 0
+
+    with open(os.path.join(outputDir_, IDS_FILENAME), 'wb') as ofile:
+        for occupation, name, filename in select_people_evenly(inputFiles, occs_to_skip):
+
+            ids = file2ids(filename, vocab)
+
+            if len(ids)==0:
+                print('ERROR: no content read for %s. Skipping...' % name)
+                continue
+
+            ids.tofile(ofile)
+            offsets.append(numIds)
+            lengths.append(len(ids))
+            labels.append(occupation if type(occupation) == str else occupation[-1])
+            names.append(name)
+
+            numIds += len(ids)
+
+    np.savez(os.path.join(outputDir_, IDS_INDEX_FILENAME),
+             offsets=np.array(offsets, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+             labels=np.array(labels), names=np.array(names))
+
+    with open(os.path.join(outputDir_, VOCAB_FILENAME), 'w', encoding='utf8') as ofile:
+        ofile.writelines(token + '\n' for token in sorted(vocab, key=vocab.get))
+
+    print('Processed %d out of %d files: %d tokens, %d unique.' % (len(names), len(inputFiles), numIds, len(vocab)))
+
+    for key in embeddings_filekeys_:
+        make_embedding_table(outputDir_, key)
+
+    return outputDir_
+
+
+def read_token_ids(dir_):
+    """
+    :return: ids (list of zero-copy memmap views, one per person), lengths, labels, names
+    """
+
+    index = np.load(os.path.join(dir_, IDS_INDEX_FILENAME))
+
+    buffer = np.memmap(os.path.join(dir_, IDS_FILENAME), dtype=np.int32, mode='r')
+    ids = [buffer[o:(o + l)] for o, l in zip(index['offsets'], index['lengths'])]
+
+    return ids, index['lengths'], index['labels'], index['names']
+
+
+def read_embedding_table(dir_, embeddings_filekey_):
+    return np.load(os.path.join(dir_, table_filename(embeddings_filekey_)))
+
+
+if __name__ == '__main__':
+    file2ids_mass(('42B300d', '6B50d'))
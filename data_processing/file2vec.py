@@ -1,10 +1,14 @@
-import string
+import string, re
 import os, glob
 import json
 import numpy as np
 import difflib
 from collections import Counter
 from random import shuffle
+from multiprocessing import Pool
+from functools import lru_cache
+
+from data_processing.embedding_cache import open_embedding_cache
 
 
 PPL_DATA_DIR = '../data/peopleData'
@@ -15,55 +19,75 @@ ALL_PUNCTUATIONS_EXCEPT_SINGLE_PERIOD = MULTI_PERIODS \
                                         + [p for p in list(string.punctuation) if p != '.']
 
 
-def extract_tokenset_from_file(inputFilename):
-    """ 
-    :return: a set 
+# every punctuation becomes its own token, except that runs of periods are split by _period_run_tokens
+_SINGLE_CHAR_PUNCTUATIONS = ''.join(p for p in ALL_PUNCTUATIONS_EXCEPT_SINGLE_PERIOD if len(p) == 1)
+_TOKEN_PATTERN = re.compile(r'\.+|[%s]|[^\s.%s]+' % (re.escape(_SINGLE_CHAR_PUNCTUATIONS), re.escape(_SINGLE_CHAR_PUNCTUATIONS)))
+_ZERO_WIDTH_TABLE = str.maketrans({joiner: ' ' for joiner in ZERO_WIDTH_UNICODES})
+
+
+@lru_cache(maxsize=None)
+def _period_run_tokens(run_):
+    """
+    the tokens that the original, quadratic tokenizer (see test_file2vec) makes out of a run of periods
+    :return: tuple of tokens
     """
 
-    with open(inputFilename, encoding='utf8') as ifile:
-        text = ' '.join(line.strip() for line in ifile.readlines())      # removes the new line character
+    for punc in MULTI_PERIODS:
+        run_ = run_.replace(punc, ' ' + punc + ' ')
 
-    return set(insert_spaces_into_corpus(text).split())
+    return tuple(t for part in run_.split() for t in ([part] if part in MULTI_PERIODS else part))
 
 
-def insert_spaces_into_corpus(text_):
+def iter_tokens(text_):
+    """
+    linear-time tokenizer. Yields exactly the tokens of insert_spaces_into_corpus(text_).split()
+    """
 
-    text_ = text_.lower()
+    for match in _TOKEN_PATTERN.finditer(text_.lower().translate(_ZERO_WIDTH_TABLE)):
+        token = match.group()
 
-    for joiner in ZERO_WIDTH_UNICODES:  # remove things like <200c> (u'\u200c')
-        text_ = text_.replace(joiner, ' ')
+        if token[0] == '.':
+            yield from _period_run_tokens(token)
+        else:
+            yield token
 
-    res = ''
 
-    for token in text_.split():
+def iter_file_tokens(inputFilename):
+    """
+    tokens of a whole file, read line by line. New lines are ignored.
+    """
 
-        for punc in ALL_PUNCTUATIONS_EXCEPT_SINGLE_PERIOD:
-            token = token.replace(punc, ' ' + punc + ' ')
+    with open(inputFilename, encoding='utf8') as ifile:
+        for line in ifile:
+            yield from iter_tokens(line)
 
-        parts = token.split()
 
-        for part in parts:  # round 2 for a single period
+def extract_tokenset_from_file(inputFilename):
+    """ 
+    :return: a set 
+    """
 
-            if '.' in part and part not in MULTI_PERIODS:
-                res += ' '.join(part.replace('.', ' . ').split()) + ' '
+    return set(iter_file_tokens(inputFilename))
 
-            else:
-                res += part + ' '
 
-    return res
+def insert_spaces_into_corpus(text_):
+    return ''.join(token + ' ' for token in iter_tokens(text_))
 
 
 def extract_embedding(embeddingsFilename_, relevantTokens_, includeUnk_ = True,
                       verbose = True):
     """
-    :param relevantTokens_: if None, then all lines in the embeddings file are returned 
+    Vectors are read from the binary cache of the embeddings file (built on first use), not from the text file.
+    :param relevantTokens_: if None, then all tokens in the embeddings file are returned, as a lazy dict-like EmbeddingCache
     :return: (dictionary, list of not found tokens if releventTokens is not None; otherwise, None) 
     """
 
-    res = {}
-    useRelevantTokens = relevantTokens_ is not None
+    cache = open_embedding_cache(embeddingsFilename_)
 
-    if includeUnk_ and useRelevantTokens:
+    if relevantTokens_ is None:
+        return cache, None
+
+    if includeUnk_:
         if type(relevantTokens_)==set:
             relevantTokens_.add('unk')
         elif type(relevantTokens_)==list:
@@ -71,48 +95,61 @@ def extract_embedding(embeddingsFilename_, relevantTokens_, includeUnk_ = True,
         else:
             raise Exception('Unknown input tokens type:', type(relevantTokens_))
 
-    with open(embeddingsFilename_, encoding='utf8') as ifile:
-        for line in ifile.readlines():
-            tokens = line.split(' ')
-            word = tokens[0]
-
-            if useRelevantTokens and word not in relevantTokens_: continue
-
-            vec = [float(t) for t in tokens[1:]]
-            res[word] = vec
+    res = {token: cache[token] for token in relevantTokens_ if token in cache}
 
     numNotFound = 0
+    notFoundTokens = set()
 
-    if useRelevantTokens:
-        notFoundTokens = set()
+    for token in relevantTokens_:
+        if token not in res:
+            numNotFound += 1
+            notFoundTokens.add(token)
 
-        for token in relevantTokens_:
-            if token not in res:
-                numNotFound += 1
-                notFoundTokens.add(token)
+            if verbose: print(token, 'not found.')
 
-                if verbose: print(token, 'not found.')
-
-        print('%d out of %d, or %.1f%% not found.' % (numNotFound, len(relevantTokens_), 100. * numNotFound / len(relevantTokens_)))
-    else:
-        notFoundTokens = None
+    print('%d out of %d, or %.1f%% not found.' % (numNotFound, len(relevantTokens_), 100. * numNotFound / len(relevantTokens_)))
 
     return res, notFoundTokens
 
 
 def file2vec(filename, embeddings_, occupation_, outputFilename = None):
-    with open(filename, encoding='utf8') as ifile:
-        text = ' '.join(line.strip() for line in ifile.readlines())
-
-    mat = np.array([embeddings_.get(token, embeddings_['unk']) for token in insert_spaces_into_corpus(text).split()])
+    unk = embeddings_['unk']
+    mat = np.array([embeddings_.get(token, unk) for token in iter_file_tokens(filename)])
 
     if outputFilename:
-        with open(outputFilename, 'w', encoding='utf8') as ofile:
-            json.dump({'occupation': occupation_, 'mat': [list(l) for l in list(mat)]}, ofile)
+        dump_json_atomically({'occupation': occupation_, 'mat': mat_to_json(mat)}, outputFilename)
 
     return mat
 
 
+def float32_str(n_):
+    """
+    :return: the shortest decimal that reads back as the same float32 (0.1f -> '0.1', not '0.10000000149011612')
+    """
+
+    return str(np.float32(n_))
+
+
+def mat_to_json(mat_):
+    """
+    mat_.tolist() of a float32 matrix gives the float64 expansions, which bloat the json
+    :return: list of rows of the shortest floats that read back as the same float32 values
+    """
+
+    return [[float(float32_str(n)) for n in row] for row in np.asarray(mat_, dtype=np.float32)]
+
+
+def dump_json_atomically(obj_, outputFilename_):
+    """
+    write to a temp file and rename it, so that a crash never leaves a half-written output behind
+    """
+
+    with open(outputFilename_ + '.tmp', 'w', encoding='utf8') as ofile:
+        json.dump(obj_, ofile)
+
+    os.replace(outputFilename_ + '.tmp', outputFilename_)
+
+
 def create_custom_embeddings_file(inputEmbeddingFilename, tokensFilename, outputFilename):
 
     # How to encode tokens that are missing from the embeddings file? Use 'unk' (which exists in the Glove embeddings file) for now
@@ -124,7 +161,7 @@ def create_custom_embeddings_file(inputEmbeddingFilename, tokensFilename, output
 
     with open(outputFilename, 'w', encoding='utf8') as outputFile:
         for k, v in embeddings.items():
-            outputFile.write(k + ' ' + ' '.join([str(n) for n in v]) + '\n')
+            outputFile.write(k + ' ' + ' '.join([float32_str(n) for n in v]) + '\n')
 
 
 def filename2name(filename_):
@@ -163,25 +200,30 @@ class OccupationReader(object):
         return res
 
 
-def file2vec_mass(embeddings_filekey_='42B300d',
-                  occs_to_skip={'explorer', 'religion', 'royalty', 'social'}):
+EMBEDDINGS_FILENAMES = \
+    {'6B50d': '../data/glove/glove.6B/glove.6B.50d.txt',
+     '6B300d': '../data/glove/glove.6B/glove.6B.300d.txt',
+     '42B300d': '../data/glove/glove.42B.300d.txt',
+     '840B300d': '../data/glove/glove.840B.300d.txt',
+     'earlylife128d_alltokens': '../data/peopleData/embeddings/earlyLifeEmbeddings.128d_alltokens.txt',
+     'earlylife128d_80pc': '../data/peopleData/embeddings/earlyLifeEmbeddings.128d_80pc.txt',
+     'earlylife200d_alltokens': '../data/peopleData/embeddings/earlyLifeEmbeddings.200d_alltokens.txt',
+     'earlylife200d_80pc': '../data/peopleData/embeddings/earlyLifeEmbeddings.200d_80pc.txt'
+     }
+
+
+def select_people_evenly(inputFiles_, occs_to_skip):
     """
-    convert all text files in a directory to matrices using a given embedding
-    :type occReader_: OccupationReader
+    read occupations and use an even number of all occupations
+    :return: list of (occupation, name, filename)
     """
 
-    processed = 0
-
     occReader_ = OccupationReader()
-    outputDir_ = os.path.join(PPL_DATA_DIR, 'earlyLifesWordMats_' + embeddings_filekey_)
-
-    if not os.path.exists(outputDir_): os.mkdir(outputDir_)
-    inputFiles = glob.glob(os.path.join(PPL_DATA_DIR, 'earlyLifesTexts/*.txt'))
 
-    # === first pass: read occupations and use an even number of all occupations ===
+    # === first pass: read occupations ===
     firstPassNames = []    # list of (occupation, name, filename)
 
-    for filename in inputFiles:
+    for filename in inputFiles_:
         name = filename2name(filename)
         occupation = occReader_.get_occupation(name)
 
@@ -207,46 +249,113 @@ def file2vec_mass(embeddings_filekey_='42B300d',
             secondPassNames.append(d)
             count_by_occ[d[0][-1]] = curCount + 1
 
-    # === second pass: convert texts to matrices ===
-    embeddings_filename_ = \
-        {'6B50d': '../data/glove/glove.6B/glove.6B.50d.txt',
-         '6B300d': '../data/glove/glove.6B/glove.6B.300d.txt',
-         '42B300d': '../data/glove/glove.42B.300d.txt',
-         '840B300d': '../data/glove/glove.840B.300d.txt',
-         'earlylife128d_alltokens': '../data/peopleData/embeddings/earlyLifeEmbeddings.128d_alltokens.txt',
-         'earlylife128d_80pc': '../data/peopleData/embeddings/earlyLifeEmbeddings.128d_80pc.txt',
-         'earlylife200d_alltokens': '../data/peopleData/embeddings/earlyLifeEmbeddings.200d_alltokens.txt',
-         'earlylife200d_80pc': '../data/peopleData/embeddings/earlyLifeEmbeddings.200d_80pc.txt'
-         }
+    return secondPassNames
 
-    embeddings, _ = extract_embedding(
-        embeddingsFilename_=embeddings_filename_[embeddings_filekey_],
-        relevantTokens_=None,
-        includeUnk_=True
-    )
+
+# next to the output directory, not in it: its readers (pack_word_mats, EmbeddingDataReader) take every *.json there
+MANIFEST_SUFFIX = '.manifest.json'
+
+_workerEmbeddings = None    # per-worker view of the memory-mapped embedding cache
+
+
+def _init_file2vec_worker(embeddingsFilename_):
+    global _workerEmbeddings
+    _workerEmbeddings, _ = extract_embedding(embeddingsFilename_, relevantTokens_=None)
+
+
+def _file2vec_worker(args):
+    """
+    :return: (name, number of rows written)
+    """
+
+    occupation, name, filename, outputFname = args
+    mat = file2vec(filename, _workerEmbeddings, occupation)
+
+    if len(mat) == 0:
+        return name, 0
+
+    dump_json_atomically({'occupation': occupation, 'mat': mat_to_json(mat)}, outputFname)
+
+    return name, len(mat)
+
+
+def file2vec_mass(embeddings_filekey_='42B300d',
+                  occs_to_skip={'explorer', 'religion', 'royalty', 'social'},
+                  numWorkers=1, manifestFlushEvery=100):
+    """
+    convert all text files in a directory to matrices using a given embedding.
+    Progress is kept in a manifest next to the output directory: a rerun resumes with the same people, and redoes
+    every output if the embedding changed since it was written.
+    :param numWorkers: number of processes. Workers memory-map the same embedding cache instead of receiving a copy.
+    :return: output directory
+    """
+
+    outputDir_ = os.path.join(PPL_DATA_DIR, 'earlyLifesWordMats_' + embeddings_filekey_)
+
+    if not os.path.exists(outputDir_): os.mkdir(outputDir_)
+    inputFiles = glob.glob(os.path.join(PPL_DATA_DIR, 'earlyLifesTexts/*.txt'))
+
+    embeddingsFilename = EMBEDDINGS_FILENAMES[embeddings_filekey_]
+    embeddings, _ = extract_embedding(embeddingsFilename_=embeddingsFilename, relevantTokens_=None)
+    embeddingsSignature = dict({k: v for k, v in embeddings.meta.items() if k != 'source'}, key=embeddings_filekey_)
     print('DONE reading embeddings.')
 
-    for occupation, name, filename in secondPassNames:
+    # === resume from the manifest, if any ===
+    manifestFilename = outputDir_ + MANIFEST_SUFFIX
+    oldManifestFilename = os.path.join(outputDir_, 'manifest.json')    # where earlier runs wrote it
+
+    if not os.path.exists(manifestFilename) and os.path.exists(oldManifestFilename):
+        os.replace(oldManifestFilename, manifestFilename)
+
+    if os.path.exists(manifestFilename):
+        with open(manifestFilename, encoding='utf8') as ifile:
+            manifest = json.load(ifile)
+
+        if manifest['embeddings'] != embeddingsSignature:
+            print('Embeddings changed since the last run. All outputs are stale.')
+            manifest['done'] = {}
+    else:
+        manifest = {'people': [list(p) for p in select_people_evenly(inputFiles, occs_to_skip)], 'done': {}}
+
+    manifest['embeddings'] = embeddingsSignature
 
+    # the selection is shuffled: keep it before any conversion, so that a crash resumes with the same people
+    dump_json_atomically(manifest, manifestFilename)
+
+    # === second pass: convert texts to matrices ===
+    todo = []
+
+    for occupation, name, filename in manifest['people']:
         outputFname = os.path.join(outputDir_, name + '.json')
 
-        if os.path.exists(outputFname):
-            print(outputFname, 'already exists. Skipping...')
+        if name in manifest['done'] and os.path.exists(outputFname):
             continue
 
-        mat = file2vec(filename, embeddings, occupation)
+        todo.append((occupation, name, filename, outputFname))
 
-        if len(mat)==0:
-            print('ERROR: no content read for %s. Skipping...' % name)
-            continue
+    print('%d of %d files already done. Converting %d with %d worker(s)...'
+          % (len(manifest['people']) - len(todo), len(manifest['people']), len(todo), numWorkers))
+
+    processed = 0
 
-        with open(outputFname, 'w', encoding='utf8') as ofile:
-            json.dump({'occupation': occupation, 'mat': [list(l) for l in list(mat)]}, ofile)
+    with Pool(numWorkers, initializer=_init_file2vec_worker, initargs=(embeddingsFilename,)) as pool:
+        for i, (name, numRows) in enumerate(pool.imap_unordered(_file2vec_worker, todo, chunksize=8)):
 
-        processed += 1
+            if numRows == 0:
+                print('ERROR: no content read for %s. Skipping...' % name)
+            else:
+                manifest['done'][name] = numRows
+                processed += 1
+
+            if (i + 1) % manifestFlushEvery == 0:
+                dump_json_atomically(manifest, manifestFilename)
+
+    dump_json_atomically(manifest, manifestFilename)
 
     print('Processed %d out of %d files.' % (processed, len(inputFiles)))
 
+    return outputDir_
+
 
 
 def file2tokens_mass(outputFname_, occupationReader_, selectedOccupations=None):
@@ -273,10 +382,8 @@ def file2tokens_mass(outputFname_, occupationReader_, selectedOccupations=None):
         if occupation is None or not isOccRelevant(occupation):
             continue
 
-        # clean text
-        with open(filename, encoding='utf8') as ifile:
-            text = ' '.join(line.strip() for line in ifile.readlines())     # new lines are ignored.
-        content = insert_spaces_into_corpus(text)
+        # clean text. new lines are ignored.
+        content = ''.join(token + ' ' for token in iter_file_tokens(filename))
 
         if len(content)==0:
             print('ERROR: no content read for %s. Skipping...' % name)
@@ -293,7 +400,7 @@ def file2tokens_mass(outputFname_, occupationReader_, selectedOccupations=None):
 
 
 if __name__ == '__main__':
-    file2vec_mass()
+    file2vec_mass(numWorkers=max(os.cpu_count() - 1, 1))
     # file2tokens_mass(os.path.join(PPL_DATA_DIR, 'tokensfiles/pol_sci.json'),
     #                  OccupationReader(),
     #                  ['politician', 'scientist'])
\ No newline at end of file
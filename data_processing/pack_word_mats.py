@@ -0,0 +1,132 @@
+import os, glob
+import json
+import tempfile
+import numpy as np
+
+from data_processing.file2vec import filename2name, file2vec_mass
+
+
+PPL_DATA_DIR = '../data/peopleData'
+PACKED_MATS_FILENAME = 'packed_mats.f32'
+PACKED_INDEX_FILENAME = 'packed_index.npz'
+
+
+def is_packed(dir_):
+    return os.path.exists(os.path.join(dir_, PACKED_MATS_FILENAME)) \
+           and os.path.exists(os.path.join(dir_, PACKED_INDEX_FILENAME))
+
+
+def source_fingerprint(inputDir_):
+    """
+    :return: number of JSON word matrices in inputDir_, their total size and their latest mtime (ns).
+             A re-run of file2vec_mass changes it.
+    """
+
+    stats = [os.stat(f) for f in glob.glob(os.path.join(inputDir_, '*.json'))]
+
+    return np.array([len(stats), sum(s.st_size for s in stats), max((s.st_mtime_ns for s in stats), default=0)],
+                    dtype=np.int64)
+
+
+def is_pack_up_to_date(dir_):
+    """
+    :return: whether the packed files in dir_ were made from the JSON word matrices that are there now.
+             True if there are no JSON files left to compare with.
+    """
+
+    fingerprint = source_fingerprint(dir_)
+    if fingerprint[0] == 0: return True
+
+    with np.load(os.path.join(dir_, PACKED_INDEX_FILENAME)) as index:
+        return 'sourceFingerprint' in index.files and np.array_equal(index['sourceFingerprint'], fingerprint)
+
+
+def pack_word_mats(inputDir_, outputDir_=None):
+    """
+    Concatenate the per-person JSON word matrices in a directory into one raw float32 buffer plus an index
+    of offsets, lengths, labels and names, so that readers can memory-map them instead of parsing JSON.
+    :param outputDir_: if None, the packed files are written into inputDir_
+    :return: number of packed matrices
+    """
+
+    outputDir_ = outputDir_ or inputDir_
+    fingerprint = source_fingerprint(inputDir_)     # before reading: a file changed meanwhile makes the pack stale
+
+    offsets = []
+    lengths = []
+    labels = []
+    names = []
+    vecDim = None
+    numRows = 0
+
+    matsFilename = os.path.join(outputDir_, PACKED_MATS_FILENAME)
+    indexFilename = os.path.join(outputDir_, PACKED_INDEX_FILENAME)
+
+    # write to temp files of its own first, so that readers (or another process packing) never see a half-written buffer
+    matsFd, matsTmpFilename = tempfile.mkstemp(suffix='.tmp', dir=outputDir_)
+    indexFd, indexTmpFilename = tempfile.mkstemp(suffix='.tmp.npz', dir=outputDir_)
+
+    try:
+        with os.fdopen(matsFd, 'wb') as ofile:
+            for inputFilename in sorted(glob.glob(os.path.join(inputDir_, '*.json'))):
+
+                with open(inputFilename, encoding='utf8') as ifile:
+                    d = json.load(ifile)
+
+                mat = np.array(d['mat'], dtype=np.float32)
+
+                if len(mat) == 0:
+                    print('ERROR: empty matrix for %s. Skipping...' % inputFilename)
+                    continue
+
+                vecDim = vecDim or mat.shape[1]
+                assert mat.shape[1] == vecDim, 'Inconsistent vector dimensions: %d vs %d.' % (mat.shape[1], vecDim)
+
+                occ = d['occupation']
+
+                mat.tofile(ofile)
+                offsets.append(numRows)
+                lengths.append(mat.shape[0])
+                labels.append(occ if type(occ) == str else occ[-1])
+                names.append(filename2name(inputFilename))
+
+                numRows += mat.shape[0]
+
+        assert names, 'No JSON word matrices found in ' + inputDir_
+
+        with os.fdopen(indexFd, 'wb') as ofile:
+            np.savez(ofile,
+                     offsets=np.array(offsets, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+                     labels=np.array(labels), names=np.array(names),
+                     shape=np.array([numRows, vecDim], dtype=np.int64), sourceFingerprint=fingerprint)
+
+        os.replace(matsTmpFilename, matsFilename)
+        os.replace(indexTmpFilename, indexFilename)
+    except BaseException:
+        for f in [matsTmpFilename, indexTmpFilename]:
+            if os.path.exists(f): os.remove(f)
+        raise
+
+    print('Packed %d matrices (%d rows x %d dims) into %s.' % (len(names), numRows, vecDim, outputDir_))
+
+    return len(names)
+
+
+def read_packed_word_mats(dir_):
+    """
+    :return: mats (list of zero-copy memmap views, one per person), lengths, labels, names
+    """
+
+    index = np.load(os.path.join(dir_, PACKED_INDEX_FILENAME))
+    numRows, vecDim = index['shape']
+
+    buffer = np.memmap(os.path.join(dir_, PACKED_MATS_FILENAME), dtype=np.float32, mode='r',
+                       shape=(int(numRows), int(vecDim)))
+
+    mats = [buffer[o:(o + l)] for o, l in zip(index['offsets'], index['lengths'])]
+
+    return mats, index['lengths'], index['labels'], index['names']
+
+
+if __name__ == '__main__':
+    pack_word_mats(file2vec_mass())
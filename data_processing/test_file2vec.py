@@ -0,0 +1,96 @@
+import os, glob
+import random
+
+from data_processing.file2vec import PPL_DATA_DIR, ZERO_WIDTH_UNICODES, MULTI_PERIODS, \
+    ALL_PUNCTUATIONS_EXCEPT_SINGLE_PERIOD, insert_spaces_into_corpus
+
+
+def insert_spaces_into_corpus_reference(text_):
+    """
+    the original quadratic tokenizer, the golden output for insert_spaces_into_corpus
+    """
+
+    text_ = text_.lower()
+
+    for joiner in ZERO_WIDTH_UNICODES:  # remove things like <200c> (u'\u200c')
+        text_ = text_.replace(joiner, ' ')
+
+    res = ''
+
+    for token in text_.split():
+
+        for punc in ALL_PUNCTUATIONS_EXCEPT_SINGLE_PERIOD:
+            token = token.replace(punc, ' ' + punc + ' ')
+
+        parts = token.split()
+
+        for part in parts:  # round 2 for a single period
+
+            if '.' in part and part not in MULTI_PERIODS:
+                res += ' '.join(part.replace('.', ' . ').split()) + ' '
+
+            else:
+                res += part + ' '
+
+    return res
+
+
+GOLDEN_TEXTS = ['He was born in St. Louis, Missouri, U.S., on 3.4.1901.',
+                'Wait... what?! No.... yes..... ok...... fine....... done.',
+                'She said “hello” – and ‘goodbye’ — then left…',
+                'Costs: £5, €10 & $20 (approx.); e.g. a/b-c_d.',
+                'zero\u200bwidth\u200cjoin\u200dhere ˈstress',
+                '...leading and trailing...',
+                'A.B.C. .. . ... ....x....y',
+                '  many   spaces\tand\ttabs  ',
+                '']
+
+
+def verify_tokenizer(inputFilenames_):
+    """
+    golden-output check: the fast tokenizer must produce the same corpus as the reference for every file
+    :return: list of files that differ
+    """
+
+    mismatches = []
+
+    for filename in inputFilenames_:
+        with open(filename, encoding='utf8') as ifile:
+            text = ' '.join(line.strip() for line in ifile.readlines())
+
+        if insert_spaces_into_corpus(text) != insert_spaces_into_corpus_reference(text):
+            mismatches.append(filename)
+
+    print('%d out of %d files tokenized differently.' % (len(mismatches), len(inputFilenames_)))
+
+    return mismatches
+
+
+def test_tokenizer_matches_reference_on_golden_texts():
+    for text in GOLDEN_TEXTS:
+        assert insert_spaces_into_corpus(text) == insert_spaces_into_corpus_reference(text), text
+
+
+def test_tokenizer_matches_reference_on_random_texts():
+    rng = random.Random(0)
+    alphabet = ['a', 'B', 'é', ' ', '\t', '.', '..', '...', '....', '…'] + ZERO_WIDTH_UNICODES \
+               + ALL_PUNCTUATIONS_EXCEPT_SINGLE_PERIOD
+
+    for _ in range(2000):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        assert insert_spaces_into_corpus(text) == insert_spaces_into_corpus_reference(text), repr(text)
+
+
+def test_tokenizer_matches_reference_on_corpus():
+    """
+    every crawled text, if they are there
+    """
+
+    assert verify_tokenizer(glob.glob(os.path.join(PPL_DATA_DIR, 'earlyLifesTexts/*.txt'))) == []
+
+
+if __name__ == '__main__':
+    test_tokenizer_matches_reference_on_golden_texts()
+    test_tokenizer_matches_reference_on_random_texts()
+    test_tokenizer_matches_reference_on_corpus()
+    print('OK')
@@ -1,25 +1,64 @@
+import os
+import hashlib
+import tempfile
 from pprint import pformat
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+from time import time
 import numpy as np
+import tensorflow as tf
 from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.preprocessing import LabelEncoder
 from collections import Counter
 from abc import ABCMeta, abstractmethod
 
 
-def one_hot(ind, vecLen):
-    res = [0] * vecLen
-    res[ind] = 1
+SPLIT_CACHE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../data/splitCache')
 
-    return np.array(res)
+# { reader settings: attributes made by _read_data_from_files }, shared by all readers in the process
+_preparedData = {}
 
 
-def train_valid_test_split(YData_, trainSize_, validSize_, testSize_, verbose_=True, logFunc_=None):
+def clear_prepared_data():
+    _preparedData.clear()
+
+
+def one_hot(ind, vecLen, dtype=np.float32):
+    """
+    :param ind: a class index, or an array of them
+    :return: one-hot rows, with a trailing axis of length vecLen
+    """
+
+    return (np.asarray(ind)[..., None] == np.arange(vecLen)).astype(dtype)
+
+
+def split_fingerprint(YData_, names_, sizes_, randomState_):
+    """
+    :return: hex digest identifying a dataset (labels and names, in order), the split sizes and the seed
+    """
+
+    h = hashlib.sha256()
+
+    for arr in [YData_, names_]:
+        h.update('\x00'.join(str(v) for v in (arr if arr is not None else [])).encode('utf8'))
+        h.update(b'\x01')
+
+    h.update(repr((sizes_, randomState_)).encode('utf8'))
+
+    return h.hexdigest()
+
+
+def train_valid_test_split(YData_, trainSize_, validSize_, testSize_, verbose_=True, logFunc_=None,
+                           randomState_=0, names_=None, cacheDir_=None):
     """
+    :param names_: part of the cache key, so that a reordered or changed dataset does not reuse a stale split
+    :param cacheDir_: if given, the indices are stored there and reused by later calls on the same data and seed
     :return: train_indices, valid_indices, test_indices 
     """
 
     logFunc_ = logFunc_ or print
 
+    YData_ = np.asarray(YData_)
     totalLen = len(YData_)
 
     # convert all lenghts to floats
@@ -28,12 +67,42 @@ def train_valid_test_split(YData_, trainSize_, validSize_, testSize_, verbose_=T
     if type(testSize_)==int: testSize_ /= 1. * totalLen
 
     assert trainSize_ + validSize_ + testSize_ == 1, \
-        'Sizes do not add up to 1: ' + trainSize_ + ' ' + validSize_ + ' ' + testSize_
+        'Sizes do not add up to 1: %s %s %s' % (trainSize_, validSize_, testSize_)
 
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=testSize_, train_size=trainSize_, random_state=0)
-    s = sss.split([None]*totalLen, YData_)
-    train_indices, test_indices = list(s)[0]
-    valid_indices = np.array([i for i in range(totalLen) if i not in train_indices and i not in test_indices])
+    cacheFilename = None
+
+    if cacheDir_:
+        fingerprint = split_fingerprint(YData_, names_, (trainSize_, validSize_, testSize_), randomState_)
+        cacheFilename = os.path.join(cacheDir_, 'split_%s.npz' % fingerprint)
+
+    if cacheFilename and os.path.exists(cacheFilename):
+        saved = np.load(cacheFilename)
+        train_indices, valid_indices, test_indices = saved['train'], saved['valid'], saved['test']
+        logFunc_('Reusing the train-validation-test split in ' + cacheFilename)
+    else:
+        sss = StratifiedShuffleSplit(n_splits=1, test_size=testSize_, train_size=trainSize_, random_state=randomState_)
+        train_indices, test_indices = next(sss.split(np.zeros(totalLen), YData_))
+
+        # everything that is in neither train nor test, in increasing order
+        isValid = np.ones(totalLen, dtype=bool)
+        isValid[train_indices] = False
+        isValid[test_indices] = False
+        valid_indices = np.flatnonzero(isValid)
+
+        if cacheFilename:
+            os.makedirs(cacheDir_, exist_ok=True)
+
+            # a temp name of its own: processes making the same split at the same time must not write into one file
+            fd, tmpFilename = tempfile.mkstemp(suffix='.tmp.npz', dir=cacheDir_)
+
+            try:
+                with os.fdopen(fd, 'wb') as ofile:
+                    np.savez(ofile, train=train_indices, valid=valid_indices, test=test_indices)
+
+                os.replace(tmpFilename, cacheFilename)
+            except BaseException:
+                os.remove(tmpFilename)
+                raise
 
     if verbose_:
 
@@ -47,41 +116,223 @@ def train_valid_test_split(YData_, trainSize_, validSize_, testSize_, verbose_=T
 
 
 
+def batch_slices(lengths_, maxBatchSize_, tokensPerBatch_=None, bucketBoundaries_=None):
+    """
+    split a sequence of examples into batches
+    :param tokensPerBatch_: if given, a batch is closed before (number of rows x longest length) exceeds it,
+                            so batches of long sequences get fewer rows
+    :param bucketBoundaries_: if given, sorted lengths that separate buckets. Examples are grouped by bucket first
+                              (keeping their order within a bucket), and no batch mixes buckets.
+    :return: list of index arrays
+    """
+
+    lengths_ = np.asarray(lengths_)
+
+    if bucketBoundaries_ is not None:
+        buckets = np.searchsorted(bucketBoundaries_, lengths_, side='right')
+        order = np.argsort(buckets, kind='stable')
+        groups = np.split(order, np.flatnonzero(np.diff(buckets[order])) + 1)
+    else:
+        groups = [np.arange(len(lengths_))]
+
+    res = []
+
+    for group in groups:
+        start = 0
+        padLen = 0
+
+        for i, l in enumerate(lengths_[group]):
+            newPadLen = max(padLen, l)
+
+            if i > start and (i - start >= maxBatchSize_
+                              or (tokensPerBatch_ and (i - start + 1) * newPadLen > tokensPerBatch_)):
+                res.append(group[start:i])
+                start = i
+                newPadLen = l
+
+            padLen = newPadLen
+
+        if start < len(group):
+            res.append(group[start:])
+
+    return res
+
+
+def padding_waste(batches_):
+    """
+    :param batches_: list of (x, y, xlengths, names). x can also be unpadded (a 1D object array), in which case
+                     it counts as padded to its longest sequence.
+    :return: fraction of the padded time steps that are padding
+    """
+
+    total = sum(len(x) * (x.shape[1] if x.ndim > 1 else xlengths.max()) for x, _, xlengths, _ in batches_)
+
+    return 1. - sum(xlengths.sum() for _, _, xlengths, _ in batches_) / total if total else 0.
+
+
+class BatchPrefetcher(object):
+    """
+    Prepares the next training batches (shuffled copies and feed dicts) in a background thread,
+    so that they are ready by the time the current sess.run returns.
+    An error in the thread is raised by the next __next__. While it runs, the reader's wherechu_at is the position
+    of the batches handed out, not of the ones prepared ahead; stop() moves the reader back there.
+    """
+
+    def __init__(self, dataReader_, queueSize_=4, shuffle_=False):
+        """
+        :type dataReader_: AbstractDataReader
+        :type queueSize_: int
+        """
+
+        assert queueSize_ > 0
+
+        self.dataReader = dataReader_
+        self.shuffle = shuffle_
+        self.position = dataReader_.trainBatchIndex   # index of the next batch __next__ hands out
+        self._queue = Queue(maxsize=queueSize_)
+        self._stopEvent = Event()
+
+        self.numFetched = 0
+        self.numStalls = 0      # fetches that found the queue empty
+        self.stallTime = 0.     # seconds the consumer spent waiting for batches
+        self.totalQueueDepth = 0
+
+        self._thread = Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item_):
+        while not self._stopEvent.is_set():
+            try:
+                self._queue.put(item_, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _produce(self):
+        while not self._stopEvent.is_set():
+            try:
+                batch = self.dataReader.get_next_training_batch(self.shuffle, inPlace_=False)
+            except Exception as e:
+                self._put((None, e))
+                return
+
+            self._put((self.dataReader.trainBatchIndex, batch))
+
+    def __iter__(self):
+        return self
+
+    def _get(self):
+        while True:
+            try:
+                return self._queue.get(timeout=0.1)
+            except Empty:
+                if not self._thread.is_alive() and self._queue.empty():
+                    raise RuntimeError('The batch prefetching thread has stopped.')
+
+    def __next__(self):
+        """
+        :return: feedict, names
+        """
+
+        depth = self._queue.qsize()
+        self.totalQueueDepth += depth
+
+        if depth == 0:
+            self.numStalls += 1
+            st = time()
+            position, res = self._get()
+            self.stallTime += time() - st
+        else:
+            position, res = self._get()
+
+        if position is None: raise res
+
+        self.position = position
+        self.numFetched += 1
+
+        return res
+
+    def stop(self):
+        self._stopEvent.set()
+
+        # unblock the producer if it is waiting on a full queue
+        try:
+            while True: self._queue.get_nowait()
+        except Empty:
+            pass
+
+        self._thread.join()
+
+        # the batches prepared ahead were not trained on
+        self.dataReader.trainBatchIndex = self.position
+        self.dataReader.prefetcher = None
+
+    @property
+    def avgQueueDepth(self):
+        return self.totalQueueDepth / max(self.numFetched, 1)
+
+    def stats(self):
+        return 'prefetched %d batches; avg queue depth %0.2f; %d stalls, %0.3f s stalled in total' \
+               % (self.numFetched, self.avgQueueDepth, self.numStalls, self.stallTime)
+
+
 class AbstractDataReader(metaclass=ABCMeta):
 
     def __init__(self, inputSource, bucketingOrRandom, batchSize_, minimumWords,
-                 loggerFactory=None, train_valid_test_split_=(0.8, 0.1, 0.1)):
+                 loggerFactory=None, train_valid_test_split_=(0.8, 0.1, 0.1), inputMode='placeholder'):
+        """
+        :param inputMode: 'placeholder': every batch is fed through feed_dict.
+                          'dataset': training batches come from an in-graph tf.data pipeline; feeding still works
+                          (validation, test, evaluate_saved_models) because the inputs are placeholders with defaults.
+        """
 
         assert bucketingOrRandom=='bucketing' or bucketingOrRandom=='random'
+        assert inputMode in ['placeholder', 'dataset']
         assert sum(train_valid_test_split_)==1. and np.all([v > 0 for v in train_valid_test_split_]), 'Invalid train-validation-test split values.'
 
         self.inputSource = inputSource
         self.minimumWords = minimumWords
         self.trainBatchIndex = 0
+        self.prefetcher = None
         self.print = loggerFactory.getLogger('DataReader').info if loggerFactory else print
         self._batchSize = batchSize_
         self._bucketingOrRandom = bucketingOrRandom
         self._train_valid_test_split = train_valid_test_split_
+        self.inputMode = inputMode
 
-        self._read_data_from_files()  # extract word2vec from files
+        # readers with the same settings (e.g. every model of a grid) share the batches; only the placeholders are new
+        key = self._prepared_data_key()
+
+        if key in _preparedData:
+            self.print('Reusing the batches prepared for %s' % (key,))
+            self.__dict__.update(_preparedData[key])
+        else:
+            before = dict(self.__dict__)
+            self._read_data_from_files()  # extract word2vec from files
+            _preparedData[key] = {k: v for k, v in self.__dict__.items() if k not in before or before[k] is not v}
+
+        self.numEpochs = 0
 
         self.x, self.y, self.numSeqs = self.setup_placeholders()
 
+        if inputMode == 'dataset':
+            self.x, self.y, self.numSeqs = self._setup_dataset_inputs(self.x, self.y, self.numSeqs)
+
 
     def _read_data_from_files(self):
 
         XData, YData_raw_labels, xLengths, names = self._read_raw_data()
 
-        # transform Y data into a one-hot matrix
+        # Y data is kept as class indices. One-hot rows are only made for the batch being fed (_feed_dict).
         self.yEncoder = LabelEncoder()
-        YData = self.yEncoder.fit_transform(YData_raw_labels) # just list of indices here
+        YData = self.yEncoder.fit_transform(YData_raw_labels).astype(np.int32)
         self.classLabels = self.yEncoder.classes_
         self.numClasses = len(self.classLabels)
-        YData = np.array([one_hot(v, len(self.classLabels)) for v in YData])
 
         # train-validation-test split
         indices = dict(zip(['train', 'valid', 'test'],
-                           train_valid_test_split(YData_raw_labels, *self._train_valid_test_split, logFunc_=self.print)))
+                           train_valid_test_split(YData_raw_labels, *self._train_valid_test_split, logFunc_=self.print,
+                                                  names_=names, cacheDir_=SPLIT_CACHE_DIR)))
 
         # bucket or sort training data
         if self._bucketingOrRandom == 'bucketing':
@@ -107,8 +358,76 @@ class AbstractDataReader(metaclass=ABCMeta):
 
         self.print('%d train batches, %d validation batches, %d test batches.' % (self.numBatches['train'], self.numBatches['valid'], self.numBatches['test']))
 
+        self.paddingWaste = {i: padding_waste(d) for i, d in self.data.items()}
+        self.print('padding waste: train %0.3f, validation %0.3f, test %0.3f' % (self.paddingWaste['train'], self.paddingWaste['valid'], self.paddingWaste['test']))
+
         del XData, YData, xLengths, names, indices  # I hope this is unnecessary. But not a lot of faith in Python's garbage-collection speed.
 
+    def _prepared_data_key(self):
+        """
+        everything the prepared batches depend on. Readers whose batches depend on more settings extend it.
+        """
+
+        return self.__class__.__name__, self.inputSource, self._bucketingOrRandom, self._batchSize, \
+               self.minimumWords, tuple(self._train_valid_test_split)
+
+    def _training_examples(self, xDtype_, yDtype_):
+        """
+        one unpadded training example at a time, visiting the prepared batches in a new random order every epoch
+        :return: generator of (x, y, xlength)
+        """
+
+        while True:
+            for b in np.random.permutation(self.numBatches['train']):
+                x, y, xlengths, _ = self.data['train'][b]
+                feedDict = self._feed_dict(x, y, xlengths)
+
+                for xRow, yRow, l in zip(feedDict[self.x], feedDict[self.y], self._example_lengths(x, xlengths)):
+                    yield xRow[:l].astype(xDtype_), yRow.astype(yDtype_), np.int32(l)
+
+    def _example_lengths(self, x, xlengths):
+        """
+        :return: the number of steps of each example of a stored batch that are not padding
+        """
+
+        return xlengths
+
+    def _setup_dataset_inputs(self, xPlaceholder, yPlaceholder, numSeqsPlaceholder, numBuckets_=8, prefetch_=4):
+        """
+        build the training input pipeline inside the graph: padded, length-bucketed batches
+        :return: x, y, numSeqs. Each defaults to the next training batch, but can still be fed.
+        """
+
+        xElementShape = xPlaceholder.get_shape()[1:]
+        yElementShape = yPlaceholder.get_shape()[1:]
+
+        dataset = tf.data.Dataset.from_generator(lambda: self._training_examples(xPlaceholder.dtype.as_numpy_dtype,
+                                                                                 yPlaceholder.dtype.as_numpy_dtype),
+                                                 (xPlaceholder.dtype, yPlaceholder.dtype, tf.int32),
+                                                 (tf.TensorShape([None]).concatenate(xElementShape[1:]),
+                                                  yElementShape, tf.TensorShape([])))
+
+        paddedShapes = (xElementShape, yElementShape, tf.TensorShape([]))
+
+        if self._bucketingOrRandom == 'bucketing':
+            lengths = np.concatenate([xlengths for _, _, xlengths, _ in self.data['train']])
+            boundaries = tf.constant(np.unique(np.percentile(lengths, np.linspace(0, 100, numBuckets_ + 1)[1:-1]).astype(np.int32)))
+
+            dataset = dataset.apply(tf.contrib.data.group_by_window(
+                key_func=lambda x, y, l: tf.reduce_sum(tf.cast(l >= boundaries, tf.int64)),
+                reduce_func=lambda _, d: d.padded_batch(self._batchSize, paddedShapes),
+                window_size=self._batchSize))
+        else:
+            dataset = dataset.shuffle(10 * self._batchSize).padded_batch(self._batchSize, paddedShapes)
+
+        x, y, numSeqs = dataset.prefetch(prefetch_).make_one_shot_iterator().get_next()
+
+        self.print('Training batches come from an in-graph %s dataset.' % self._bucketingOrRandom)
+
+        return tf.placeholder_with_default(x, xPlaceholder.get_shape()), \
+               tf.placeholder_with_default(y, yPlaceholder.get_shape()), \
+               tf.placeholder_with_default(numSeqs, [None])
+
     @classmethod
     def maker_from_premade_source(cls, sourceName, **otherArgs):
         """
@@ -117,6 +436,15 @@ class AbstractDataReader(metaclass=ABCMeta):
 
         return lambda **kwargs: cls(cls.premade_sources()[sourceName], **otherArgs, **kwargs)
 
+    @classmethod
+    def prepare_shared_source(cls, inputSource):
+        """
+        one-time conversion of a source into a form that many readers (e.g. parallel trials) can memory-map.
+        Nothing to do by default.
+        """
+
+        pass
+
     @classmethod
     @abstractmethod
     def premade_sources(cls):
@@ -137,12 +465,21 @@ class AbstractDataReader(metaclass=ABCMeta):
     def start_batch_from_beginning(self):
         self.trainBatchIndex = 0
 
+    def start_batch_from(self, batchIndex_):
+        """
+        e.g. to carry on from where a checkpoint's training stopped
+        """
+
+        assert self.prefetcher is None, 'Stop the running prefetcher first.'
+        self.trainBatchIndex = batchIndex_ % self.numBatches['train']
+
     def wherechu_at(self):
-        return self.trainBatchIndex
+        return self.trainBatchIndex if self.prefetcher is None else self.prefetcher.position
 
-    def get_next_training_batch(self, shuffle=False):
+    def get_next_training_batch(self, shuffle=False, inPlace_=True):
         """
         :type shuffle: bool 
+        :param inPlace_: if False, shuffled batches are copies and the stored batch is left untouched
         :return: feedict, names
         """
 
@@ -150,22 +487,49 @@ class AbstractDataReader(metaclass=ABCMeta):
 
         if shuffle:
             orders = np.random.permutation(len(x))
-            np.take(x, orders, axis=0, out=x)
-            np.take(y, orders, axis=0, out=y)
-            np.take(xlengths, orders, out=xlengths)
-            np.take(names, orders, out=names)
+
+            if inPlace_:
+                np.take(x, orders, axis=0, out=x)
+                np.take(y, orders, axis=0, out=y)
+                np.take(xlengths, orders, out=xlengths)
+                np.take(names, orders, out=names)
+            else:
+                x, y, xlengths, names = (np.take(a, orders, axis=0) for a in (x, y, xlengths, names))
 
         self.trainBatchIndex = (self.trainBatchIndex + 1) % self.numBatches['train']
 
-        return {self.x: x, self.y: y, self.numSeqs: xlengths}, names
+        if self.trainBatchIndex == 0:
+            self.numEpochs += 1
+            self.print('Finished epoch %d.' % self.numEpochs)
+
+        return self._feed_dict(x, y, xlengths, pooled_=True), names
+
+    def prefetch_training_batches(self, queueSize_=4, shuffle_=False):
+        """
+        :return: a BatchPrefetcher. Iterate over it instead of calling get_next_training_batch. Call stop() when done.
+        """
+
+        assert self.prefetcher is None, 'Stop the running prefetcher first.'
+        self.prefetcher = BatchPrefetcher(self, queueSize_, shuffle_)
+
+        return self.prefetcher
 
     def get_validation_data_in_batches(self):
         for x, y, xlengths, names in self.data['valid']:
-            yield {self.x: x, self.y: y, self.numSeqs: xlengths}, names
+            yield self._feed_dict(x, y, xlengths), names
 
     def get_test_data_in_batches(self):
         for x, y, xlengths, names in self.data['test']:
-            yield {self.x: x, self.y: y, self.numSeqs: xlengths}, names
+            yield self._feed_dict(x, y, xlengths), names
+
+    def _feed_dict(self, x, y, xlengths, pooled_=False):
+        """
+        :param y: class indices of the batch
+        :param pooled_: whether x may be padded into a reused buffer. Only for the training stream of
+                        get_next_training_batch, whose buffers in use the prefetch queue accounts for.
+        """
+
+        return {self.x: x, self.y: one_hot(y, self.numClasses), self.numSeqs: xlengths}
 
     @property
     def input(self):
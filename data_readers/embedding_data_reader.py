@@ -1,47 +1,168 @@
 import tensorflow as tf
 import json, os, glob
+from threading import Lock
+from collections import OrderedDict
 import numpy as np
 
-from data_readers.abstract_data_reader import AbstractDataReader
-from data_processing.file2vec import filename2name
+from data_readers.abstract_data_reader import AbstractDataReader, batch_slices
+from data_processing.file2vec import filename2name, MANIFEST_SUFFIX
+from data_processing.pack_word_mats import is_packed, is_pack_up_to_date, pack_word_mats, read_packed_word_mats
+from data_processing.file2ids import PADDING_ID, is_token_ids, read_token_ids, read_embedding_table
 
 
 PPL_DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../data/peopleData/')
 
-def patch_arrays(arrays, lengths, numrows=None):
+def object_array(arrays):
     """
-    patch all arrays to have the same number of rows
-    :param numrows: if None, patch to the max number of rows in the arrays
-    :param arrays: 
-    :return:  
+    np.array() would stack equally-shaped matrices into one (copied) 3D array; keep them as separate views instead
+    """
+
+    res = np.empty(len(arrays), dtype=object)
+
+    for i, arr in enumerate(arrays):
+        res[i] = arr
+
+    return res
+
+
+class PaddingBufferPool(object):
     """
+    A ring of preallocated batch buffers per (shape, dtype), for batches that are assembled when they are fed.
+    A buffer is handed out again after ringSize_ more requests of the same shape, so at most ringSize_ batches
+    of one shape may be in use at once (prefetch queue + the batch being run + the one being made; see
+    EmbeddingDataReader.prefetch_training_batches). So only the training stream takes buffers from it.
+    Padded lengths are rounded up to a multiple of padMultiple_, so that batches of similar lengths share buffers,
+    and only the maxShapes_ most recently used shapes are kept, so the pool does not grow with every length.
+    """
+
+    def __init__(self, ringSize_=8, padMultiple_=32, maxShapes_=16):
+        self.ringSize = ringSize_
+        self.padMultiple = padMultiple_
+        self.maxShapes = maxShapes_
+        self._rings = OrderedDict()
+        self._lock = Lock()
+
+        self.numAllocated = 0
+        self.numReused = 0
+
+    def get(self, shape_, dtype_):
+        """
+        :return: a buffer of shape_, except that its second dimension (the padded length) may be rounded up
+        """
+
+        shape = (shape_[0], -(-shape_[1] // self.padMultiple) * self.padMultiple) + tuple(shape_[2:])
+        key = (shape, np.dtype(dtype_).str)
+
+        with self._lock:
+            buffers, nextIndex = self._rings.pop(key, ([], 0))
+
+            if len(buffers) < self.ringSize:
+                res = np.empty(shape, dtype=dtype_)
+                buffers.append(res)
+                self.numAllocated += 1
+            else:
+                res = buffers[nextIndex]
+                self.numReused += 1
+
+            self._rings[key] = (buffers, (nextIndex + 1) % self.ringSize)    # most recently used last
+
+            # the buffers of evicted shapes that are still in use stay valid; they are just not handed out again
+            while len(self._rings) > self.maxShapes:
+                self._rings.popitem(last=False)
+
+        return res
+
+
+def pad_into(out_, arrays, lengths, padValue_=0):
+    """
+    write the arrays into the first rows of out_ with one vectorized scatter, and padValue_ everywhere else.
+    out_ does not have to be clean, so pooled buffers can be reused.
+    """
+
+    numRows, padLen = out_.shape[:2]
+    lengths = np.asarray(lengths)
+
+    if lengths.sum() > 0:
+        rowInds = np.repeat(np.arange(numRows), lengths)
+        colInds = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        out_[rowInds, colInds] = np.concatenate([a[:l] for a, l in zip(arrays, lengths)])
+
+    out_[np.arange(padLen)[None, :] >= lengths[:, None]] = padValue_
+
+    return out_
+
+
+def _padded_shape(arrays, lengths, numrows):
 
     assert len(arrays) == len(lengths)
 
     # pad to the largest array
     padLen = lengths.max()
     assert numrows is None or numrows >= padLen, 'numrows is fewer than the max number of rows: %d vs %d.' % (numrows, padLen)
-    padLen = numrows or padLen
 
-    res = np.zeros( (len(arrays), padLen, arrays[0].shape[1]) )
+    return (len(arrays), numrows or padLen) + arrays[0].shape[1:]
 
-    for i, arr in enumerate(arrays):
-        res[i][:arr.shape[0], :] = arr
 
-    return res
+def patch_arrays(arrays, lengths, numrows=None, pool=None):
+    """
+    patch all arrays to have the same number of rows
+    :param numrows: if None, patch to the max number of rows in the arrays
+    :param arrays: 
+    :param pool: PaddingBufferPool to take the float32 buffer from; if None, a new one is allocated
+    :return:  
+    """
+
+    shape = _padded_shape(arrays, lengths, numrows)
+    res = pool.get(shape, np.float32) if pool else np.empty(shape, dtype=np.float32)
+
+    return pad_into(res, arrays, lengths)
+
+
+def patch_ids(ids, lengths, numrows=None, pool=None):
+    """
+    like patch_arrays, but for 1D arrays of token ids. Padded with PADDING_ID.
+    """
+
+    shape = _padded_shape(ids, lengths, numrows)
+    res = pool.get(shape, np.int32) if pool else np.empty(shape, dtype=np.int32)
+
+    return pad_into(res, ids, lengths, PADDING_ID)
 
 
 class EmbeddingDataReader(AbstractDataReader):
 
     def __init__(self, inputFilesDir, bucketingOrRandom, batchSize_, minimumWords=40,
-                 loggerFactory=None, train_valid_test_split_=(0.8, 0.1, 0.1), padToFull=False):
+                 loggerFactory=None, train_valid_test_split_=(0.8, 0.1, 0.1), padToFull=False,
+                 embeddingsKey='42B300d', inputMode='placeholder',
+                 bucketBoundaries=None, tokensPerBatch=None, lazyPadding=False):
+        """
+        :param embeddingsKey: which embedding table to look token ids up in. Only used for token-ID sources.
+        :param bucketBoundaries: sequence lengths at which a new batch has to start
+        :param tokensPerBatch: padding budget; batches of long sequences shrink so that rows x padded length stays under it
+        :param lazyPadding: if True, batches are stored unpadded and padded when they are fed (training batches into
+                            pooled buffers), instead of keeping every padded batch in memory
+        """
+
+        assert not (lazyPadding and padToFull), 'padToFull needs the padded batches to be made up front.'
 
         self.padToFull = padToFull
+        self.bucketBoundaries = None if bucketBoundaries is None else np.sort(bucketBoundaries)
+        self.tokensPerBatch = tokensPerBatch
+        self.embeddingsKey = embeddingsKey
+        self.embeddingTable = None
+        self.lazyPadding = lazyPadding
+        self.paddingPool = PaddingBufferPool() if lazyPadding else None
 
         super().__init__(inputFilesDir, bucketingOrRandom, batchSize_, minimumWords,
-                         loggerFactory, train_valid_test_split_)
+                         loggerFactory, train_valid_test_split_, inputMode)
 
         self.print('padToFull: ' + str(padToFull))
+        self.print('bucket boundaries: %s; tokens per batch: %s' % (bucketBoundaries, tokensPerBatch))
+        self.print('lazyPadding: ' + str(lazyPadding))
+
+    def _prepared_data_key(self):
+        return super()._prepared_data_key() + (self.padToFull, self.embeddingsKey, self.tokensPerBatch, self.lazyPadding,
+                                               None if self.bucketBoundaries is None else tuple(self.bucketBoundaries))
 
     def setup_placeholders(self):
 
@@ -51,40 +172,76 @@ class EmbeddingDataReader(AbstractDataReader):
                tf.placeholder(tf.int32)
 
     def _read_raw_data(self):
-        XData = []
-        xLengths = []
-        YData = []
-        names = []
 
         self.print('======= Reading pre-made vector files... =======')
         self.print('Data source: ' + self.inputSource)
 
-        numSkipped = 0
+        if is_token_ids(self.inputSource):
+            self.print('Reading token ids with the %s embedding table.' % self.embeddingsKey)
+            mats, lengths, labels, names = read_token_ids(self.inputSource)
+            self.embeddingTable = read_embedding_table(self.inputSource, self.embeddingsKey)
+        elif is_packed(self.inputSource):
+            if not is_pack_up_to_date(self.inputSource):
+                self.print('The JSON word matrices changed since they were packed. Repacking...')
+                pack_word_mats(self.inputSource)
+
+            self.print('Memory-mapping packed word matrices.')
+            mats, lengths, labels, names = read_packed_word_mats(self.inputSource)
+        else:
+            mats, lengths, labels, names = self._read_json_mats()
+
+        # the embedding the inputs come from, if the source says: token ids name their table, and word matrices
+        # made by file2vec_mass have it in their manifest. embeddingsKey's default says nothing about word matrices.
+        self.sourceEmbeddingsKey = self.embeddingsKey if self.embeddingTable is not None else self._word_mats_embeddings_key()
+
+        keep = np.array(lengths) >= self.minimumWords
+        numSkipped = len(keep) - keep.sum()
+
+        XData = object_array([m for m, k in zip(mats, keep) if k])
+        xLengths = np.array(lengths)[keep]
+
+        self.vectorDimension = XData[0].shape[1] if self.embeddingTable is None else self.embeddingTable.shape[1]
+        self.maxXLen = xLengths.max()
+
+        self.print('%d out of %d skipped' % (numSkipped, len(keep)))
+
+        return XData, np.array(labels)[keep], xLengths, np.array(names)[keep]
+
+    def _word_mats_embeddings_key(self):
+        """
+        :return: the embedding key in the file2vec_mass manifest next to the source directory, or None if there is none
+        """
+
+        manifestFilename = os.path.normpath(self.inputSource) + MANIFEST_SUFFIX
+        if not os.path.exists(manifestFilename): return None
+
+        with open(manifestFilename, encoding='utf8') as ifile:
+            return json.load(ifile).get('embeddings', {}).get('key')
+
+    def _read_json_mats(self):
+        """
+        :return: mats, lengths, labels, names
+        """
+
+        mats = []
+        lengths = []
+        labels = []
+        names = []
+
         for inputFilename in glob.glob(os.path.join(self.inputSource, '*.json')):
 
             with open(inputFilename, encoding='utf8') as ifile:
                 d = json.load(ifile)
 
             occ = d['occupation']
-            occ = occ if type(occ) == str else occ[-1]
+            mat = np.array(d['mat'], dtype=np.float32)
 
-            mat = np.array(d['mat'])
-
-            if len(mat) < self.minimumWords:
-                numSkipped += 1
-                continue
-
-            XData.append(mat)
-            xLengths.append(mat.shape[0])
-            YData.append(occ)
+            mats.append(mat)
+            lengths.append(mat.shape[0])
+            labels.append(occ if type(occ) == str else occ[-1])
             names.append(filename2name(inputFilename))
 
-        self.vectorDimension = XData[0].shape[1]
-        self.maxXLen = max([d.shape[0] for d in XData])
-
-        self.print('%d out of %d skipped' % (numSkipped, numSkipped + len(XData)))
-
-        return np.array(XData), np.array(YData), np.array(xLengths), np.array(names)
+        return mats, lengths, labels, names
 
     def _put_data_into_batches(self, xData_, yData_, xLengths_, names_):
         """
@@ -95,17 +252,50 @@ class EmbeddingDataReader(AbstractDataReader):
         assert len(xData_) == len(xLengths_) == len(yData_) == len(names_)
 
         res = []
-        total = len(xData_)
+        patch = patch_arrays if self.embeddingTable is None else patch_ids
 
-        startInds = list(range(0, total, self._batchSize))
-        stopInds = startInds[1:] + [total]
+        for inds in batch_slices(xLengths_, self._batchSize,
+                                 None if self.padToFull else self.tokensPerBatch, self.bucketBoundaries):
+            if self.lazyPadding:
+                x = xData_[inds]   # object array of unpadded matrices; padded in _feed_dict
+            else:
+                x = patch(xData_[inds], xLengths_[inds], self.maxXLen if self.padToFull else None)
 
-        for start, stop in zip(startInds, stopInds):
-            x = patch_arrays(xData_[start:stop], xLengths_[start:stop], self.maxXLen if self.padToFull else None)
-            res.append((x, yData_[start:stop], xLengths_[start:stop], names_[start:stop]))
+            res.append((x, yData_[inds], xLengths_[inds], names_[inds]))
 
         return res
 
+    def prefetch_training_batches(self, queueSize_=4, shuffle_=False):
+
+        # the queued batches, the one being run and the one being made must not share a pooled buffer
+        if self.paddingPool is not None:
+            assert queueSize_ + 2 <= self.paddingPool.ringSize, \
+                'A prefetch queue of %d needs a padding pool ring of at least %d.' % (queueSize_, queueSize_ + 2)
+
+        return super().prefetch_training_batches(queueSize_, shuffle_)
+
+    def _feed_dict(self, x, y, xlengths, pooled_=False):
+
+        # evaluation batches get buffers of their own: from the pool, they could overwrite queued training batches
+        if self.lazyPadding:
+            x = (patch_arrays if self.embeddingTable is None else patch_ids)(x, xlengths,
+                                                                              pool=self.paddingPool if pooled_ else None)
+
+        # token-ID batches are only expanded into vectors when they are fed
+        if self.embeddingTable is not None:
+            x = self.embeddingTable[x]
+
+        return super()._feed_dict(x, y, xlengths, pooled_)
+
+    @classmethod
+    def prepare_shared_source(cls, inputSource):
+        """
+        pack JSON word matrices, so that every reader memory-maps the same file instead of parsing its own copy
+        """
+
+        if not is_token_ids(inputSource) and not (is_packed(inputSource) and is_pack_up_to_date(inputSource)):
+            pack_word_mats(inputSource)
+
     @classmethod
     def premade_sources(cls):
 
@@ -117,7 +307,8 @@ class EmbeddingDataReader(AbstractDataReader):
                 'small_2occupations': _p('earlyLifesWordMats/politician_scientist'),
                 'small': _p('earlyLifesWordMats'),
                 'full_2occupations': _p('earlyLifesWordMats_42B300d/politician_scientist'),
-                'full': _p('earlyLifesWordMats_42B300d')}
+                'full': _p('earlyLifesWordMats_42B300d'),
+                'full_ids': _p('earlyLifesTokenIds')}
 
 
 if __name__ == '__main__':
@@ -1,40 +1,108 @@
 import tensorflow as tf
 from tensorflow.contrib.learn import preprocessing
 import json, os
+import hashlib
+import tempfile
 import numpy as np
 
 from data_readers.abstract_data_reader import AbstractDataReader
+from data_readers.embedding_data_reader import object_array, patch_ids
 
 
 PPL_DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../data/peopleData/')
 
+TOKEN_IDS_FILENAME = 'ids.i32'
+TOKEN_INDEX_FILENAME = 'index.npz'
+VOCAB_PROCESSOR_FILENAME = 'vocab_processor.pkl'
+META_FILENAME = 'meta.json'
+
+
+def file_sha256(filename_, chunkSize_=1024**2):
+    h = hashlib.sha256()
+
+    with open(filename_, 'rb') as ifile:
+        for chunk in iter(lambda: ifile.read(chunkSize_), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def write_atomically(filename_, write_):
+    """
+    write_(a temp filename next to filename_), then rename it to filename_: readers, and processes building the same
+    cache at the same time, see either no file or a whole one
+    :param write_: filename -> None. The temp name has filename_'s extension, so e.g. np.savez does not add one.
+    """
+
+    fd, tmpFilename = tempfile.mkstemp(suffix='.tmp' + os.path.splitext(filename_)[1], dir=os.path.dirname(filename_))
+    os.close(fd)
+
+    try:
+        write_(tmpFilename)
+        os.replace(tmpFilename, filename_)
+    except BaseException:
+        if os.path.exists(tmpFilename): os.remove(tmpFilename)
+        raise
+
+
+def token_cache_dir(inputFilename_, minimumWords_):
+    # the vocabulary is fitted on the kept documents only, so it depends on minimumWords
+    return os.path.join(inputFilename_ + '.cache', 'min%d' % minimumWords_)
+
 
 class TextDataReader(AbstractDataReader):
 
     def __init__(self, inputFilename, bucketingOrRandom, batchSize_, minimumWords,
-                 loggerFactory=None, train_valid_test_split_=(0.8, 0.1, 0.1)):
+                 loggerFactory=None, train_valid_test_split_=(0.8, 0.1, 0.1), inputMode='placeholder', padToFull=True):
+        """
+        :param padToFull: if True, every batch is padded to the longest document (the convolutional models need a fixed width).
+                          Otherwise, to the longest document in the batch.
+        """
+
+        self.padToFull = padToFull
 
         super().__init__(inputFilename, bucketingOrRandom, batchSize_, minimumWords,
-                         loggerFactory, train_valid_test_split_)
+                         loggerFactory, train_valid_test_split_, inputMode)
 
 
     def setup_placeholders(self):
 
         # in the order of: x, y, numSeqs
-        return tf.placeholder(tf.int32, [None, self.maxXLen]), \
+        return tf.placeholder(tf.int32, [None, self.maxXLen if self.padToFull else None]), \
                tf.placeholder(tf.float32, [None, self.numClasses]), \
                tf.placeholder(tf.int32)
 
     def _read_raw_data(self):
 
+        self.print('======= Reading pre-made vector files... =======')
+        self.print('Data source: ' + self.inputSource)
+
+        cacheDir = token_cache_dir(self.inputSource, self.minimumWords)
+        sourceHash = file_sha256(self.inputSource)
+        metaFilename = os.path.join(cacheDir, META_FILENAME)
+        meta = None
+
+        if os.path.exists(metaFilename):
+            with open(metaFilename, encoding='utf8') as ifile:
+                meta = json.load(ifile)
+
+        if meta is None or meta['sha256'] != sourceHash:
+            self._build_token_cache(cacheDir, sourceHash)
+        else:
+            self.print('Reusing the vocabulary and token ids in ' + cacheDir)
+
+        return self._read_token_cache(cacheDir)
+
+    def _build_token_cache(self, cacheDir_, sourceHash_):
+        """
+        fit the vocabulary once and store it with the ragged int32 token ids (one buffer + offsets) in cacheDir_
+        """
+
         XData = []
         xLengths = []
         YData = []
         names = []
 
-        self.print('======= Reading pre-made vector files... =======')
-        self.print('Data source: ' + self.inputSource)
-
         numSkipped = 0
 
         with open(self.inputSource, encoding='utf8') as ifile:
@@ -54,17 +122,67 @@ class TextDataReader(AbstractDataReader):
                 names.append(d['name'])
 
         self.print('%d out of %d skipped' % (numSkipped, numSkipped + len(XData)))
-        self.maxXLen = max(xLengths)
+        maxXLen = max(xLengths)
+
+        vocabProcessor = preprocessing.VocabularyProcessor(maxXLen)
+        vocabProcessor.fit(XData)
+
+        os.makedirs(cacheDir_, exist_ok=True)
+
+        # meta is removed first and written last: a cache without meta is rebuilt
+        metaFilename = os.path.join(cacheDir_, META_FILENAME)
+        if os.path.exists(metaFilename): os.remove(metaFilename)
+
+        idLengths = []
+
+        def _write_ids(filename_):
+            with open(filename_, 'wb') as ofile:
+                for row in vocabProcessor.transform(XData):
+                    # every token of a fitted document is in the vocabulary, so the ids are a non-zero prefix of the row
+                    ids = row[:np.count_nonzero(row)].astype(np.int32)
+
+                    ids.tofile(ofile)
+                    idLengths.append(len(ids))
+
+        write_atomically(os.path.join(cacheDir_, TOKEN_IDS_FILENAME), _write_ids)
+
+        idLengths = np.array(idLengths, dtype=np.int64)
+        offsets = np.cumsum(idLengths) - idLengths
+        numIds = int(idLengths.sum())
+
+        write_atomically(os.path.join(cacheDir_, TOKEN_INDEX_FILENAME),
+                         lambda f: np.savez(f, offsets=offsets, idLengths=idLengths,
+                                            xLengths=np.array(xLengths), labels=np.array(YData), names=np.array(names)))
+
+        write_atomically(os.path.join(cacheDir_, VOCAB_PROCESSOR_FILENAME), vocabProcessor.save)
 
-        self.vocabProcessor = preprocessing.VocabularyProcessor(self.maxXLen)
-        XData = list(self.vocabProcessor.fit_transform(XData))
+        def _write_meta(filename_):
+            with open(filename_, 'w', encoding='utf8') as ofile:
+                json.dump({'sha256': sourceHash_, 'maxXLen': maxXLen, 'numIds': numIds}, ofile)
+
+        write_atomically(metaFilename, _write_meta)
+
+        self.print('Cached %d token ids of %d documents in %s.' % (numIds, len(names), cacheDir_))
+
+    def _read_token_cache(self, cacheDir_):
+
+        with open(os.path.join(cacheDir_, META_FILENAME), encoding='utf8') as ifile:
+            meta = json.load(ifile)
+
+        index = np.load(os.path.join(cacheDir_, TOKEN_INDEX_FILENAME))
+        buffer = np.memmap(os.path.join(cacheDir_, TOKEN_IDS_FILENAME), dtype=np.int32, mode='r', shape=(meta['numIds'],))
+
+        self.maxXLen = meta['maxXLen']
+        self.vocabProcessor = preprocessing.VocabularyProcessor.restore(os.path.join(cacheDir_, VOCAB_PROCESSOR_FILENAME))
         self.vocabSize = len(self.vocabProcessor.vocabulary_)
 
-        return np.array(XData), np.array(YData), np.array(xLengths), np.array(names)
+        XData = object_array([buffer[o:(o + l)] for o, l in zip(index['offsets'], index['idLengths'])])
+
+        return XData, index['labels'], index['xLengths'], index['names']
 
     def _put_data_into_batches(self, xData_, yData_, xLengths_, names_):
         """
-        :param xData_: 3D array of shape (number of arrays, sequences, vecDim)
+        :param xData_: 1D object array of ragged token id arrays. They are only padded when fed (_feed_dict).
         :return: a list of tuples [({x, y, xlengths, names}]
         """
 
@@ -81,6 +199,18 @@ class TextDataReader(AbstractDataReader):
                  names_[start:stop])
                 for start, stop in zip(startInds, stopInds)]
 
+    def _example_lengths(self, x, xlengths):
+
+        # xlengths counts space-separated words, which can differ from the number of ids
+        return np.array([len(ids) for ids in x])
+
+    def _feed_dict(self, x, y, xlengths, pooled_=False):
+
+        idLengths = self._example_lengths(x, xlengths)
+        padLen = self.maxXLen if self.padToFull else max(xlengths.max(), idLengths.max())
+
+        return super()._feed_dict(patch_ids(x, idLengths, padLen), y, xlengths, pooled_)
+
     @classmethod
     def premade_sources(cls):
 
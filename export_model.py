@@ -0,0 +1,169 @@
+import os, sys, json
+from time import time
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL']='1'  # Defaults to 0: all logs; 1: filter out INFO logs; 2: filter out WARNING; 3: filter out errors
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from layers.abstract_layer import set_inference_mode
+
+
+MODEL_INFO_FILENAME = 'model_info.json'
+FROZEN_GRAPH_FILENAME = 'frozen_inference_graph.pb'
+
+INPUT_NAMES = ['x', 'numSeqs']
+OUTPUT_NAME = 'probabilities'
+
+# the frozen graph is already cut down to what OUTPUT_NAME needs (convert_variables_to_constants), so no strip_unused_nodes
+GRAPH_TRANSFORMS = ['remove_nodes(op=Identity, op=CheckNumerics)',
+                    'fold_constants(ignore_errors=true)',
+                    'merge_duplicate_nodes',
+                    'sort_by_execution_order']
+
+
+def build_inference_graph(modelKlass, modelParams_, xShape_, xDtype_, numClasses_):
+    """
+    build the model in a new graph in inference mode: no dropout, optimizer or summaries, and named inputs and output
+    :return: graph, {x, numSeqs} placeholders, probabilities tensor
+    """
+
+    graph = tf.Graph()
+
+    with graph.as_default():
+        set_inference_mode()
+
+        input_ = {'x': tf.placeholder(xDtype_, xShape_, name='x'),
+                  'y': tf.placeholder(tf.float32, [None, numClasses_], name='y'),
+                  'numSeqs': tf.placeholder(tf.int32, [None], name='numSeqs')}
+
+        model = modelKlass(input_=input_, **modelParams_)
+        probabilities = tf.nn.softmax(model.output, name=OUTPUT_NAME)
+
+    return graph, {n: input_[n] for n in INPUT_NAMES}, probabilities
+
+
+def optimize_graph_def(graphDef_, transforms_=GRAPH_TRANSFORMS):
+    """
+    :type graphDef_: tf.GraphDef
+    :return: graphDef_ rewritten by the graph transform tool
+    """
+
+    return TransformGraph(graphDef_, INPUT_NAMES, [OUTPUT_NAME], transforms_)
+
+
+def load_frozen_graph(filename_):
+    """
+    :return: graph, {x, numSeqs} input tensors, probabilities tensor
+    """
+
+    graphDef = tf.GraphDef()
+
+    with open(filename_, 'rb') as ifile:
+        graphDef.ParseFromString(ifile.read())
+
+    graph = tf.Graph()
+
+    with graph.as_default():
+        tf.import_graph_def(graphDef, name='')
+
+    return graph, {n: graph.get_tensor_by_name(n + ':0') for n in INPUT_NAMES}, graph.get_tensor_by_name(OUTPUT_NAME + ':0')
+
+
+def _run_graph_def(graphDef_, feeds_):
+    """
+    :return: probabilities of each feed, seconds per feed
+    """
+
+    graph = tf.Graph()
+
+    with graph.as_default():
+        tf.import_graph_def(graphDef_, name='')
+
+    inputs = {n: graph.get_tensor_by_name(n + ':0') for n in INPUT_NAMES}
+    probabilities = graph.get_tensor_by_name(OUTPUT_NAME + ':0')
+
+    with tf.Session(graph=graph) as sess:
+        sess.run(probabilities, {inputs[n]: v for n, v in feeds_[0].items()})     # warm up
+
+        startTime = time()
+        res = [sess.run(probabilities, {inputs[n]: v for n, v in f.items()}) for f in feeds_]
+
+    return res, (time() - startTime) / len(feeds_)
+
+
+def export_frozen_graph(modelKlass, modelParams_, checkpointPath_, exportDir_, dataReader_,
+                        transforms=GRAPH_TRANSFORMS, numCheckBatches=4, tolerance=1e-5):
+    """
+    Restore a training checkpoint into an inference-mode graph, fold its variables into constants and optimize it
+    with the graph transform tool. Both graphs are checked against the checkpoint on some validation batches; if the
+    transformed one does not match (or does not run), the plain frozen one is written instead.
+    :type dataReader_: AbstractDataReader
+    :param dataReader_: gives the input shape, the class labels and the batches to check on
+    :return: path of the written graph
+    """
+
+    graph, inputs, probabilities = build_inference_graph(modelKlass, modelParams_,
+                                                         dataReader_.x.get_shape(), dataReader_.x.dtype,
+                                                         dataReader_.numClasses)
+
+    feeds = [{'x': fd[dataReader_.x], 'numSeqs': fd[dataReader_.numSeqs]}
+             for (fd, _), _ in zip(dataReader_.get_validation_data_in_batches(), range(numCheckBatches))]
+
+    with tf.Session(graph=graph) as sess:
+        tf.train.Saver(tf.global_variables()).restore(sess, checkpointPath_)
+
+        expected = [sess.run(probabilities, {inputs[n]: v for n, v in f.items()}) for f in feeds]
+        frozen = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [OUTPUT_NAME])
+
+    candidates = [('transformed', lambda: optimize_graph_def(frozen, transforms)), ('frozen', lambda: frozen)]
+    graphDef = None
+
+    for name, make in candidates:
+        try:
+            candidate = make()
+            res, secondsPerBatch = _run_graph_def(candidate, feeds)
+        except Exception as e:
+            print('The %s graph does not run: %s: %s' % (name, e.__class__.__name__, e))
+            continue
+
+        maxDiff = max(float(np.abs(r - ex).max()) for r, ex in zip(res, expected))
+
+        print('%s graph: %d nodes, max difference %0.2e, %0.2f ms per batch'
+              % (name, len(candidate.node), maxDiff, secondsPerBatch * 1e3))
+
+        if maxDiff <= tolerance:
+            graphDef = candidate
+            break
+
+    if graphDef is None: raise ValueError('No exported graph matches the checkpoint ' + checkpointPath_)
+
+    if not os.path.exists(exportDir_): os.makedirs(exportDir_)
+    outputFilename = os.path.join(exportDir_, FROZEN_GRAPH_FILENAME)
+
+    with open(outputFilename, 'wb') as ofile:
+        ofile.write(graphDef.SerializeToString())
+
+    with open(os.path.join(exportDir_, MODEL_INFO_FILENAME), 'w', encoding='utf8') as ofile:
+        json.dump({'classLabels': list(dataReader_.classLabels), 'xShape': dataReader_.x.get_shape().as_list(),
+                   'vecDim': getattr(dataReader_, 'vectorDimension', None),
+                   'embeddingsKey': getattr(dataReader_, 'sourceEmbeddingsKey', None),
+                   'checkpoint': checkpointPath_, 'frozenGraph': FROZEN_GRAPH_FILENAME}, ofile)
+
+    print('Exported %s to %s (%0.1f MB, %d nodes)'
+          % (checkpointPath_, outputFilename, os.path.getsize(outputFilename) / 1024**2, len(graphDef.node)))
+
+    return outputFilename
+
+
+if __name__ == '__main__':
+    # usage: python export_model.py <checkpoint> <model params json> <export dir>; see Mark6.read_params for the json
+    from data_readers.embedding_data_reader import EmbeddingDataReader
+    from models.mark6 import Mark6
+
+    checkpointPath, paramsFilename, exportDir = sys.argv[1:4]
+
+    with tf.Graph().as_default():
+        dataReader = EmbeddingDataReader.maker_from_premade_source('full')(bucketingOrRandom='bucketing', batchSize_=100, minimumWords=40)
+
+    export_frozen_graph(Mark6, Mark6.read_params(paramsFilename), checkpointPath, exportDir, dataReader)
@@ -0,0 +1,282 @@
+import os, sys, json
+import threading
+from time import time
+from queue import Queue, Empty
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL']='1'  # Defaults to 0: all logs; 1: filter out INFO logs; 2: filter out WARNING; 3: filter out errors
+import tensorflow as tf
+
+from data_processing.file2vec import EMBEDDINGS_FILENAMES, iter_tokens
+from data_processing.embedding_cache import open_embedding_cache
+from data_readers.abstract_data_reader import batch_slices
+from data_readers.embedding_data_reader import patch_arrays
+from models.mark6 import Mark6
+from export_model import MODEL_INFO_FILENAME, FROZEN_GRAPH_FILENAME, OUTPUT_NAME, build_inference_graph, load_frozen_graph
+from train import MODEL_INFO_SUFFIX
+
+
+def export_saved_model(modelKlass, modelParams_, checkpointPath_, exportDir_, classLabels_, vecDim_, embeddingsKey_):
+    """
+    restore a training checkpoint into an inference-mode graph and save it as a SavedModel, with the class labels
+    and embedding it expects in model_info.json
+    :return: exportDir_
+    """
+
+    graph, inputs, probabilities = build_inference_graph(modelKlass, modelParams_, [None, None, vecDim_], tf.float32,
+                                                         len(classLabels_))
+
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        tf.train.Saver(tf.global_variables()).restore(sess, checkpointPath_)
+        tf.saved_model.simple_save(sess, exportDir_, inputs=inputs, outputs={OUTPUT_NAME: probabilities})
+
+    with open(os.path.join(exportDir_, MODEL_INFO_FILENAME), 'w', encoding='utf8') as ofile:
+        json.dump({'classLabels': list(classLabels_), 'vecDim': vecDim_, 'embeddingsKey': embeddingsKey_,
+                   'checkpoint': checkpointPath_}, ofile)
+
+    print('Exported %s to %s' % (checkpointPath_, exportDir_))
+
+    return exportDir_
+
+
+class Predictor(object):
+    """
+    An exported model (a SavedModel, or a frozen graph from export_model.export_frozen_graph) in its own graph and
+    session, plus what turns texts into its inputs
+    """
+
+    def __init__(self, exportDir_, numThreads=None):
+
+        with open(os.path.join(exportDir_, MODEL_INFO_FILENAME), encoding='utf8') as ifile:
+            self.info = json.load(ifile)
+
+        assert self.info.get('embeddingsKey') in EMBEDDINGS_FILENAMES, \
+            'The model in %s does not say which embedding its inputs come from (embeddingsKey: %s).' \
+            % (exportDir_, self.info.get('embeddingsKey'))
+
+        self.classLabels = self.info['classLabels']
+        self.embeddings = open_embedding_cache(EMBEDDINGS_FILENAMES[self.info['embeddingsKey']])
+        self.unk = self.embeddings['unk']
+
+        assert self.info.get('vecDim') in [None, self.embeddings.vecDim], \
+            'The model in %s takes %d-dimensional vectors, but the %s embedding has %d.' \
+            % (exportDir_, self.info['vecDim'], self.info['embeddingsKey'], self.embeddings.vecDim)
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=numThreads or 0, inter_op_parallelism_threads=numThreads or 0)
+
+        if os.path.exists(os.path.join(exportDir_, FROZEN_GRAPH_FILENAME)):
+            self.graph, inputs, self.probabilities = load_frozen_graph(os.path.join(exportDir_, FROZEN_GRAPH_FILENAME))
+            self.x, self.numSeqs = inputs['x'], inputs['numSeqs']
+            self.sess = tf.Session(graph=self.graph, config=config)
+            return
+
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+        signature = tf.saved_model.loader.load(self.sess, [tf.saved_model.tag_constants.SERVING], exportDir_) \
+            .signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+
+        self.x = self.graph.get_tensor_by_name(signature.inputs['x'].name)
+        self.numSeqs = self.graph.get_tensor_by_name(signature.inputs['numSeqs'].name)
+        self.probabilities = self.graph.get_tensor_by_name(signature.outputs[OUTPUT_NAME].name)
+
+    def tokens_to_mat(self, tokens_):
+        return self.embeddings.lookup(tokens_, default=self.unk)[0]
+
+    def text_to_mat(self, text_):
+        return self.tokens_to_mat(list(iter_tokens(text_)))
+
+    def predict_mats(self, mats_):
+        """
+        :return: (number of matrices x number of classes) probabilities
+        """
+
+        lengths = np.array([len(m) for m in mats_])
+
+        return self.sess.run(self.probabilities, {self.x: patch_arrays(mats_, lengths), self.numSeqs: lengths})
+
+
+class InferenceServer(object):
+    """
+    Micro-batches concurrent requests: waits up to maxWaitSeconds for up to maxBatchSize requests, sorts them by
+    length and runs them in batches of similar lengths (at most tokensPerBatch padded steps), so short texts are not
+    padded to the longest one. Keeps per-request latencies for p50/p99 and throughput.
+    """
+
+    def __init__(self, predictor_, maxBatchSize=32, maxWaitSeconds=0.005, tokensPerBatch=20000, numLatencies=10000):
+        """
+        :type predictor_: Predictor
+        """
+
+        self.predictor = predictor_
+        self.maxBatchSize = maxBatchSize
+        self.maxWaitSeconds = maxWaitSeconds
+        self.tokensPerBatch = tokensPerBatch
+
+        self._requests = Queue()
+        self._stopEvent = threading.Event()
+        self._latencies = deque(maxlen=numLatencies)
+        self._lock = threading.Lock()
+
+        self.startTime = time()
+        self.numRequests = 0
+        self.numBatches = 0
+
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def submit(self, mat_):
+        """
+        :return: Future of the probabilities of each class
+        """
+
+        res = Future()
+        self._requests.put((mat_, res, time()))
+
+        return res
+
+    def predict(self, text=None, tokens=None):
+        """
+        blocking; one of text or tokens
+        :return: { class label: probability }
+        """
+
+        assert (text is None) != (tokens is None), 'Give either text or tokens.'
+
+        mat = self.predictor.text_to_mat(text) if text is not None else self.predictor.tokens_to_mat(tokens)
+        if len(mat) == 0: raise ValueError('No tokens to classify.')
+
+        return dict(zip(self.predictor.classLabels, self.submit(mat).result().tolist()))
+
+    def _collect(self):
+        try:
+            pending = [self._requests.get(timeout=0.1)]
+        except Empty:
+            return []
+
+        deadline = time() + self.maxWaitSeconds
+
+        while len(pending) < self.maxBatchSize:
+            try:
+                pending.append(self._requests.get(timeout=max(deadline - time(), 0)))
+            except Empty:
+                break
+
+        return pending
+
+    def _serve(self):
+        while not self._stopEvent.is_set():
+            pending = sorted(self._collect(), key=lambda r: len(r[0]))
+            if not pending: continue
+
+            lengths = [len(r[0]) for r in pending]
+
+            for inds in batch_slices(lengths, self.maxBatchSize, self.tokensPerBatch):
+                batch = [pending[i] for i in inds]
+
+                try:
+                    probs = self.predictor.predict_mats([r[0] for r in batch])
+                except Exception as e:
+                    for _, future, _ in batch: future.set_exception(e)
+                    continue
+
+                now = time()
+
+                with self._lock:
+                    self.numBatches += 1
+                    self.numRequests += len(batch)
+                    self._latencies.extend(now - t for _, _, t in batch)
+
+                for (_, future, _), p in zip(batch, probs):
+                    future.set_result(p)
+
+    def stats(self):
+
+        with self._lock:
+            latencies = np.array(self._latencies)
+            numRequests, numBatches = self.numRequests, self.numBatches
+
+        return {'requests': numRequests, 'batches': numBatches,
+                'avgBatchSize': numRequests / max(numBatches, 1),
+                'throughputPerSecond': numRequests / (time() - self.startTime),
+                'p50LatencyMs': float(np.percentile(latencies, 50) * 1e3) if len(latencies) else None,
+                'p99LatencyMs': float(np.percentile(latencies, 99) * 1e3) if len(latencies) else None}
+
+    def stop(self):
+        self._stopEvent.set()
+        self._thread.join()
+
+
+def make_http_handler(server_):
+    """
+    POST /predict with {"text": "..."} or {"tokens": [...]} -> {"probabilities": {label: p}}; GET /stats
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code_, obj_):
+            body = json.dumps(obj_).encode('utf8')
+
+            self.send_response(code_)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, server_.stats())
+            else:
+                self._reply(404, {'error': 'unknown path ' + self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'unknown path ' + self.path})
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8'))
+                self._reply(200, {'probabilities': server_.predict(request.get('text'), request.get('tokens'))})
+            except (ValueError, AssertionError, KeyError, TypeError, AttributeError) as e:     # a malformed request
+                self._reply(400, {'error': '%s: %s' % (e.__class__.__name__, e)})
+            except Exception as e:
+                print('ERROR: /predict failed: %s: %s' % (e.__class__.__name__, e))
+                self._reply(500, {'error': 'internal error: %s' % e.__class__.__name__})
+
+        def log_message(self, format, *args):
+            pass    # one line per request would cost more than the prediction
+
+    return Handler
+
+
+def serve_http(server_, host='127.0.0.1', port=8008):
+    httpd = ThreadingHTTPServer((host, port), make_http_handler(server_))
+    print('Serving predictions on http://%s:%d/predict' % (host, port))
+
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        server_.stop()
+
+
+if __name__ == '__main__':
+    # usage: python inference_server.py <checkpoint> <model params json> <export dir> [port]
+    # the class labels and input come from the checkpoint's model info (written by train); see Mark6.read_params for the json
+    checkpointPath, paramsFilename, exportDir = sys.argv[1:4]
+
+    if not os.path.exists(os.path.join(exportDir, MODEL_INFO_FILENAME)):
+        with open(checkpointPath + MODEL_INFO_SUFFIX, encoding='utf8') as ifile:
+            checkpointInfo = json.load(ifile)
+
+        assert checkpointInfo['embeddingsKey'] in EMBEDDINGS_FILENAMES, \
+            "The data source of %s does not say which embedding it was made with; set embeddingsKey in %s." \
+            % (checkpointPath, checkpointPath + MODEL_INFO_SUFFIX)
+
+        export_saved_model(Mark6, Mark6.read_params(paramsFilename), checkpointPath, exportDir,
+                           checkpointInfo['classLabels'], checkpointInfo['vecDim'], checkpointInfo['embeddingsKey'])
+
+    serve_http(InferenceServer(Predictor(exportDir)), port=int(sys.argv[4]) if len(sys.argv) > 4 else 8008)
@@ -1,9 +1,44 @@
-from tensorflow import name_scope
+import tensorflow as tf
+from tensorflow import name_scope, add_to_collection, get_collection
 from abc import ABCMeta, abstractmethod
 
 from utilities import str_2_activation_function
 
 
+INFERENCE_MODE_COLLECTION = 'inference_mode'
+IS_TRAINING_COLLECTION = 'is_training'
+
+
+def set_inference_mode():
+    """
+    mark the default graph as an inference graph: layers built in it afterwards skip dropout and models skip
+    the optimizer and summaries. Variable names are unchanged, so training checkpoints restore into it.
+    """
+
+    add_to_collection(INFERENCE_MODE_COLLECTION, True)
+
+
+def is_inference_mode():
+    return len(get_collection(INFERENCE_MODE_COLLECTION)) > 0
+
+
+def is_training():
+    """
+    :return: the default graph's scalar bool 'is_training' tensor, made on first use. It is True unless fed False,
+             as AbstractModel.evaluate does, so training feeds need not change.
+    """
+
+    res = get_collection(IS_TRAINING_COLLECTION)
+    if res: return res[0]
+
+    with tf.get_default_graph().name_scope(None):     # the same top-level name whichever layer asks first
+        res = tf.placeholder_with_default(True, [], name='is_training')
+
+    add_to_collection(IS_TRAINING_COLLECTION, res)
+
+    return res
+
+
 class AbstractLayer(metaclass=ABCMeta):
 
     def __init__(self, input_, inputDim_, activation=None, loggerFactory=None):
@@ -44,6 +79,15 @@ class AbstractLayer(metaclass=ABCMeta):
     def input_modifier(self, val):
         return val
 
+    def dropout(self, val_, keepProb_):
+        """
+        :return: val_ with dropout while training; val_ itself when is_training is fed False, without drawing random numbers
+        """
+
+        if is_inference_mode() or keepProb_ >= 1: return val_
+
+        return tf.cond(is_training(), lambda: tf.nn.dropout(val_, keepProb_), lambda: val_)
+
     @property
     def input(self):
         return self.__input
@@ -50,7 +50,7 @@ class ConvLayer(AbstractLayer):
 
         self.conv = tf.nn.conv2d(self.input, filterMat, strides=[1, *self.strides, 1], padding=self.padding, name='conv')    # supports only 'VALID' for now
 
-        self.output = tf.nn.dropout(
+        self.output = self.dropout(
             tf.nn.bias_add(self.conv, filterBiases),
             self.keepProb)
 
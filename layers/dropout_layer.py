@@ -22,7 +22,7 @@ class DropoutLayer(AbstractLayer):
         self.print('dropout keep prob: %0.3f' % keepProb)
 
     def make_graph(self):
-        self.output = tf.nn.dropout(self.input, self.keepProb)
+        self.output = self.dropout(self.input, self.keepProb)
 
     @property
     def output_shape(self):
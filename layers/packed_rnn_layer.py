@@ -0,0 +1,90 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL']='1'  # Defaults to 0: all logs; 1: filter out INFO logs; 2: filter out WARNING; 3: filter out errors
+import tensorflow as tf
+from tensorflow.python.util import nest
+
+from utilities import last_relevant
+from data_readers.embedding_data_reader import EmbeddingDataReader
+from layers.rnn_layer import RNNLayer
+
+
+# ------ bi-directional RNN layer that does not run over padding ------
+class PackedRNNLayer(RNNLayer):
+    """
+    RNNLayer whose LSTM stacks only run on the sequences that have not ended yet. The batch is sorted by decreasing
+    length and run time-major, so at step t the active sequences are the first (number of lengths > t) rows, and the
+    cells (and their state) are cut down to them: the work is proportional to the real tokens, not to
+    batch size x max length. The backward direction reverses each sequence within its length first, so it packs the
+    same way. The variables are RNNLayer's, so checkpoints are interchangeable.
+    """
+
+    def __init__(self, input_, inputDim_,
+                 numLSTMUnits_, outputKeepProbs_=1., numStepsToOutput_=1,
+                 activation=None, loggerFactory=None, cellType='basic'):
+
+        assert cellType != 'fused', 'The fused cell runs whole sequences; it cannot be packed.'
+
+        super().__init__(input_, inputDim_, numLSTMUnits_, outputKeepProbs_, numStepsToOutput_,
+                         activation, loggerFactory, cellType)
+
+    def make_graph(self):
+
+        self.forwardCells = self.make_stacked_cells()
+        self.backwardCells = self.make_stacked_cells()
+
+        lengths, order = tf.nn.top_k(self.numSeqs, k=tf.shape(self.numSeqs)[0])    # longest first
+        xSorted = tf.gather(self.x, order)
+        reverse = lambda t: tf.reverse_sequence(t, lengths, seq_axis=1, batch_axis=0)
+        outputs = []
+
+        with tf.variable_scope('bidirectional_rnn'):    # RNNLayer's variable names
+            for direction, cells, isBackward in [('fw', self.forwardCells, False), ('bw', self.backwardCells, True)]:
+                with tf.variable_scope(direction):
+                    val = self.packed_rnn(cells, reverse(xSorted) if isBackward else xSorted, lengths)
+
+                outputs.append(reverse(val) if isBackward else val)
+
+        self.outputs = tf.gather(tf.concat(outputs, 2), tf.invert_permutation(order))
+        self.output = last_relevant(self.outputs, self.numSeqs, self.numStepsToOutput)
+
+    def packed_rnn(self, cells_, x_, lengths_):
+        """
+        :param x_: batch size x max length x vec dim, sorted by decreasing length
+        :param lengths_: sorted lengths
+        :return: batch size x max(longest length, 1) x cells_.output_size outputs, zeros past each sequence's length
+        """
+
+        batchSize = tf.shape(x_)[0]
+
+        # at least one step, so that a batch of empty sequences still has outputs to stack (all zeros)
+        numSteps = tf.maximum(tf.reduce_max(lengths_), 1)
+        x_ = tf.pad(x_[:, :numSteps], [[0, 0], [0, numSteps - tf.minimum(tf.shape(x_)[1], numSteps)], [0, 0]])
+        inputs = tf.TensorArray(tf.float32, size=numSteps).unstack(tf.transpose(x_, [1, 0, 2]))
+        initState = cells_.zero_state(batchSize, tf.float32)
+
+        def _step(t, state, outputs):
+            numActive = tf.reduce_sum(tf.cast(lengths_ > t, tf.int32))
+            output, state = cells_(inputs.read(t)[:numActive], nest.map_structure(lambda s: s[:numActive], state))
+
+            return t + 1, state, outputs.write(t, tf.pad(output, [[0, batchSize - numActive], [0, 0]]))
+
+        # the state's batch dimension is already unknown (zero_state of a tensor batch size), so it may shrink
+        _, _, outputs = tf.while_loop(lambda t, *_: t < numSteps, _step,
+                                      [tf.constant(0), initState, tf.TensorArray(tf.float32, size=numSteps)],
+                                      swap_memory=True)
+
+        res = tf.transpose(outputs.stack(), [1, 0, 2])
+        res.set_shape([None, None, cells_.output_size])
+
+        return res
+
+
+if __name__ == '__main__':
+    dr = EmbeddingDataReader('../data/peopleData/2_samples', 'bucketing', 10, 50)
+    maker = PackedRNNLayer.new([32, 16], [0.5, 1.], 3)
+    layer = maker(dr.input, [10, -1])
+
+    sess = tf.InteractiveSession()
+    sess.run(tf.global_variables_initializer())
+
+    print(sess.run(layer.output, dr.get_next_training_batch()[0]).shape)    # should be of shape 10 x 3 x 32
@@ -1,11 +1,52 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL']='1'  # Defaults to 0: all logs; 1: filter out INFO logs; 2: filter out WARNING; 3: filter out errors
 import tensorflow as tf
-from tensorflow.contrib.rnn import BasicLSTMCell, MultiRNNCell, DropoutWrapper
+from tensorflow.contrib.rnn import BasicLSTMCell, LSTMBlockCell, LSTMBlockFusedCell, MultiRNNCell, RNNCell
 
 from utilities import last_relevant
 from data_readers.embedding_data_reader import EmbeddingDataReader
-from layers.abstract_layer import AbstractLayer
+from layers.abstract_layer import AbstractLayer, is_training, is_inference_mode
+
+
+# basic: BasicLSTMCell, a dozen small ops per step.
+# block: LSTMBlockCell, one fused op per step. fused: LSTMBlockFusedCell, one op per layer and direction for the whole
+#   sequence (time-major). Both keep BasicLSTMCell's variable names and layout, so checkpoints are interchangeable.
+# cudnn_compatible: CudnnCompatibleLSTMCell (a block cell without forget bias), whose checkpoints load into CudnnLSTM
+#   on GPU, but not into the other backends.
+CELL_TYPES = ['basic', 'block', 'fused', 'cudnn_compatible']
+
+
+class OutputDropoutWrapper(RNNCell):
+    """
+    DropoutWrapper's output dropout, done by a layer's dropout: when is_training is fed False, no random mask is
+    drawn at all (DropoutWrapper with a keep prob of 1 still draws one per step). Like DropoutWrapper, it adds no
+    variable scope, so checkpoints are unchanged.
+    """
+
+    def __init__(self, cell_, dropout_):
+        """
+        :param dropout_: output -> output with dropout, e.g. lambda v: layer.dropout(v, keepProb)
+        """
+
+        super().__init__()
+        self._cell = cell_
+        self._dropout = dropout_
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def zero_state(self, batch_size, dtype):
+        return self._cell.zero_state(batch_size, dtype)
+
+    def __call__(self, inputs, state, scope=None):
+        output, newState = self._cell(inputs, state, scope=scope)
+
+        return self._dropout(output), newState
 
 
 # ------ stack of LSTM - bi-directional RNN layer ------
@@ -13,19 +54,22 @@ class RNNLayer(AbstractLayer):
 
     def __init__(self, input_, inputDim_,
                  numLSTMUnits_, outputKeepProbs_=1., numStepsToOutput_=1,
-                 activation=None, loggerFactory=None):
+                 activation=None, loggerFactory=None, cellType='basic'):
         """
         :type input_: dict
         :type numLSTMUnits_: list
         :type numStepsToOutput_: int
         :type outputKeepProbs_: Union[list, float]
+        :param cellType: one of CELL_TYPES
         """
 
         assert 'x' in input_ and 'numSeqs' in input_, 'Currently RNN works only as the top layer.'
+        assert cellType in CELL_TYPES, 'Unknown cell type ' + str(cellType)
 
         self.numLSTMUnits = numLSTMUnits_
         self.outputKeepProbs = [outputKeepProbs_] * len(numLSTMUnits_) if type(outputKeepProbs_) in [float, int] else outputKeepProbs_
         self.numStepsToOutput = numStepsToOutput_
+        self.cellType = cellType
 
         self.x = input_['x']
         self.numSeqs = input_['numSeqs']
@@ -35,9 +79,15 @@ class RNNLayer(AbstractLayer):
         self.print('# LSTM cell units: ' + str(numLSTMUnits_))
         self.print('dropout keep probs: ' + str(outputKeepProbs_))
         self.print('output %d steps' % numStepsToOutput_)
+        self.print('cell type: ' + cellType)
 
     def make_graph(self):
 
+        if self.cellType == 'fused':
+            self.outputs = self.make_fused_outputs()
+            self.output = last_relevant(self.outputs, self.numSeqs, self.numStepsToOutput)
+            return
+
         self.forwardCells = self.make_stacked_cells()
         self.backwardCells = self.make_stacked_cells()
 
@@ -49,21 +99,57 @@ class RNNLayer(AbstractLayer):
 
         self.output = last_relevant(self.outputs, self.numSeqs, self.numStepsToOutput)
 
+    def make_cell(self, numUnits_):
+
+        if self.cellType == 'block': return LSTMBlockCell(numUnits_, name='basic_lstm_cell')
+        if self.cellType == 'cudnn_compatible':
+            from tensorflow.contrib.cudnn_rnn import CudnnCompatibleLSTMCell    # only when asked: not in every TF build
+
+            return CudnnCompatibleLSTMCell(numUnits_)
+
+        return BasicLSTMCell(numUnits_)
+
     def make_stacked_cells(self):
 
-        return MultiRNNCell([DropoutWrapper(BasicLSTMCell(f), output_keep_prob=k)
+        if not is_inference_mode(): is_training()     # made here, not inside the RNN's while loop on the first step
+
+        return MultiRNNCell([OutputDropoutWrapper(self.make_cell(f), lambda v, k=k: self.dropout(v, k))
                              for f, k in zip(self.numLSTMUnits, self.outputKeepProbs)])
 
+    def make_fused_outputs(self):
+        """
+        the same stacks as make_stacked_cells, under the variable scopes bidirectional_dynamic_rnn gives them
+        :return: batch size x max length x (2 x last layer's units) outputs, zeros past each sequence's length
+        """
+
+        xTimeMajor = tf.transpose(self.x, [1, 0, 2])
+        reverse = lambda t: tf.reverse_sequence(t, self.numSeqs, seq_axis=0, batch_axis=1)
+        outputs = []
+
+        with tf.variable_scope('bidirectional_rnn'):
+            for direction, isBackward in [('fw', False), ('bw', True)]:
+                val = reverse(xTimeMajor) if isBackward else xTimeMajor
+
+                with tf.variable_scope(direction + '/multi_rnn_cell'):
+                    for i, (f, k) in enumerate(zip(self.numLSTMUnits, self.outputKeepProbs)):
+                        with tf.variable_scope('cell_%d' % i):
+                            val, _ = LSTMBlockFusedCell(f, name='basic_lstm_cell')(val, dtype=tf.float32, sequence_length=self.numSeqs)
+                            val = self.dropout(val, k)
+
+                outputs.append(reverse(val) if isBackward else val)
+
+        return tf.transpose(tf.concat(outputs, 2), [1, 0, 2])
+
     @property
     def output_shape(self):
         return self.inputDim[0], self.numStepsToOutput, 2*self.numLSTMUnits[-1]
 
     @classmethod
     def new(cls, numLSTMUnits_, outputKeepProbs_=1., numStepsToOutput_=1,
-            activation=None):
+            activation=None, cellType='basic'):
 
         return lambda input_, inputDim_, loggerFactory=None: \
-            cls(input_, inputDim_, numLSTMUnits_, outputKeepProbs_, numStepsToOutput_, activation, loggerFactory)
+            cls(input_, inputDim_, numLSTMUnits_, outputKeepProbs_, numStepsToOutput_, activation, loggerFactory, cellType)
 
 
 
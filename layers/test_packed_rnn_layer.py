@@ -0,0 +1,92 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL']='1'  # Defaults to 0: all logs; 1: filter out INFO logs; 2: filter out WARNING; 3: filter out errors
+import numpy as np
+import tensorflow as tf
+
+from layers.rnn_layer import RNNLayer
+from layers.packed_rnn_layer import PackedRNNLayer
+
+
+def build_on_shared_weights(numLSTMUnits_, vecDim_, cellType='basic'):
+    """
+    :return: {x, numSeqs} placeholders, RNNLayer, PackedRNNLayer reusing the RNNLayer's variables
+    """
+
+    input_ = {'x': tf.placeholder(tf.float32, [None, None, vecDim_]), 'numSeqs': tf.placeholder(tf.int32, [None])}
+
+    with tf.variable_scope('shared'):
+        plain = RNNLayer(input_, (-1, -1, vecDim_), list(numLSTMUnits_), cellType=cellType)
+
+    numVariables = len(tf.trainable_variables())
+
+    with tf.variable_scope('shared', reuse=True):
+        packed = PackedRNNLayer(input_, (-1, -1, vecDim_), list(numLSTMUnits_), cellType=cellType)
+
+    assert len(tf.trainable_variables()) == numVariables, 'PackedRNNLayer made variables of its own.'
+
+    return input_, plain, packed
+
+
+def check_packed_matches_rnn_layer(lengths=(13, 1, 6, 0, 13, 2, 9), numLSTMUnits=(8, 5), vecDim=4, numPadding=3,
+                                   cellType='basic', tolerance=1e-5):
+    """
+    the same skewed batch through both layers: outputs, and gradients w.r.t. the variables and x, must be equal.
+    The padding is random, not zeros, so anything that reads past a sequence's length shows up.
+    """
+
+    rng = np.random.RandomState(0)
+    maxLength = max(lengths)
+
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+
+        input_, plain, packed = build_on_shared_weights(numLSTMUnits, vecDim, cellType)
+        lossWeights = tf.constant(rng.randn(len(lengths), maxLength, 2 * numLSTMUnits[-1]), tf.float32)
+        wrt = tf.trainable_variables() + [input_['x']]
+
+        res = {}
+
+        for name, layer in [('plain', plain), ('packed', packed)]:
+            outputs = layer.outputs[:, :maxLength]
+            res[name] = [outputs, layer.outputs[:, maxLength:]] + tf.gradients(tf.reduce_sum(outputs * lossWeights), wrt)
+
+        feed = {input_['x']: rng.randn(len(lengths), maxLength + numPadding, vecDim), input_['numSeqs']: lengths}
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            plainRes, packedRes = sess.run([res['plain'], res['packed']], feed)
+
+    assert not plainRes[1].any() and packedRes[1].size == 0
+
+    for name, p, q in zip(['outputs'] + [v.name for v in wrt], plainRes[:1] + plainRes[2:], packedRes[:1] + packedRes[2:]):
+        assert p.shape == q.shape, '%s: shapes %s and %s' % (name, p.shape, q.shape)
+        assert np.abs(p - q).max() <= tolerance, '%s: max difference %0.2e' % (name, np.abs(p - q).max())
+
+    return True
+
+
+def test_packed_matches_rnn_layer():
+    assert check_packed_matches_rnn_layer(cellType='basic')
+
+
+def test_packed_matches_rnn_layer_with_block_cells():
+    assert check_packed_matches_rnn_layer(cellType='block')
+
+
+def test_packed_runs_a_batch_of_empty_sequences():
+
+    with tf.Graph().as_default():
+        input_, _, packed = build_on_shared_weights([6], 3)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs = sess.run(packed.outputs, {input_['x']: np.zeros((2, 0, 3)), input_['numSeqs']: [0, 0]})
+
+    assert outputs.shape == (2, 1, 12) and not outputs.any()
+
+
+if __name__ == '__main__':
+    test_packed_matches_rnn_layer()
+    test_packed_matches_rnn_layer_with_block_cells()
+    test_packed_runs_a_batch_of_empty_sequences()
+    print('OK')
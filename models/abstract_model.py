@@ -4,7 +4,9 @@ import os
 
 from abc import ABCMeta, abstractmethod
 from utilities import run_with_processor
+from layers.abstract_layer import is_inference_mode, is_training
 from train import train
+from sweep import run_sweep, run_successive_halving
 
 
 
@@ -30,6 +32,7 @@ class AbstractModel(metaclass=ABCMeta):
         self.x = input_['x']
         self.y = input_['y']
         self.numSeqs = input_['numSeqs']
+        self.isTraining = is_training()
         self.vecDim = self.x.get_shape()[-1].value
         self.numClasses = self.y.get_shape()[-1].value
         self.outputs = []
@@ -51,6 +54,12 @@ class AbstractModel(metaclass=ABCMeta):
 
             self.accuracy = tf.reduce_mean(tf.cast(tf.equal(self.pred, self.trueY), tf.float32))
 
+            # an inference graph (layers.abstract_layer.set_inference_mode) has no optimizer slots or summaries
+            if is_inference_mode():
+                self.optimizer = None
+                self.merged_summaries = None
+                return
+
             summary.scalar('cost', self.cost)
             summary.scalar('accuracy', self.accuracy)
 
@@ -67,16 +76,30 @@ class AbstractModel(metaclass=ABCMeta):
         assert newLearningRate_ > 0
         sess_.run(tf.assign(self._lr, newLearningRate_))
 
-    def train_op(self, sess_, feedDict_, computeMetrics_):
-        thingsToRun = [self.optimizer] + [self.merged_summaries, self.cost, self.accuracy] if computeMetrics_ else []
+    def train_op(self, sess_, feedDict_, computeMetrics_, computeSummaries_=True, runOptions_=None, runMetadata_=None):
+        """
+        :param computeSummaries_: if False, the summaries are not evaluated and None is returned in their place
+        :param runOptions_: tf.RunOptions, e.g. for tracing; runMetadata_ receives the trace
+        :return: [summaries, cost, accuracy] if computeMetrics_
+        """
+
+        thingsToRun = [self.optimizer]
+
+        if computeMetrics_:
+            thingsToRun += ([self.merged_summaries] if computeSummaries_ else []) + [self.cost, self.accuracy]
 
-        return sess_.run(thingsToRun, feedDict_)[1:]
+        res = sess_.run(thingsToRun, feedDict_, options=runOptions_, run_metadata=runMetadata_)[1:]
+
+        return [None] + res if computeMetrics_ and not computeSummaries_ else res
 
     def evaluate(self, sess_, feedDict_, full=False):
+        """
+        runs without dropout (is_training fed False)
+        """
 
         return sess_.run([self.cost, self.accuracy, self.trueY, self.pred]
                          + ([self.y, self.output] if full else []),
-                         feedDict_)
+                         {**feedDict_, self.isTraining: False})
 
 
     def add_output(self, output, outputShape):
@@ -134,13 +157,24 @@ class AbstractModel(metaclass=ABCMeta):
 
 
     @classmethod
-    def run_thru_data(cls, dataReaderKlass, dataScale, modelParams, runScale, useCPU=True, **otherDataReaderKwargs):
+    def run_thru_data(cls, dataReaderKlass, dataScale, modelParams, runScale, useCPU=True, numParallel=1,
+                      halvingEta=None, **otherDataReaderKwargs):
         """
         :type dataScale: str
         :type modelParams: list
         :type runScale: str
+        :param numParallel: if more than 1, trials run that many at a time in separate processes (see sweep.run_sweep)
+        :param halvingEta: if given, search the grid by successive halving, keeping the best 1/halvingEta of
+                           the configs after each budget (see sweep.run_successive_halving)
         """
 
+        if halvingEta:
+            return run_successive_halving(cls, dataReaderKlass, dataScale, modelParams, runScale, useCPU, numParallel,
+                                          halvingEta, **otherDataReaderKwargs)
+
+        if numParallel > 1:
+            return run_sweep(cls, dataReaderKlass, dataScale, modelParams, runScale, useCPU, numParallel, **otherDataReaderKwargs)
+
         dataReaderMaker = dataReaderKlass.maker_from_premade_source(dataScale, **otherDataReaderKwargs)
 
         for p in modelParams:
@@ -1,18 +1,23 @@
+import json
 import tensorflow as tf
+from time import time
 
 from models.abstract_model import AbstractModel
 from data_readers.embedding_data_reader import EmbeddingDataReader
-from layers.rnn_layer import RNNLayer
+from layers.rnn_layer import RNNLayer, CELL_TYPES
+from layers.packed_rnn_layer import PackedRNNLayer
 from layers.fully_connected_layer import FullyConnectedLayer
 from layers.dropout_layer import DropoutLayer
 
-from utilities import make_params_dict
+from utilities import make_params_dict, run_with_processor
 
 
 class RNNConfig(object):
-    def __init__(self, numCellUnits, keepProbs=1, activation=None):
+    def __init__(self, numCellUnits, keepProbs=1, activation=None, cellType='basic', packed=False):
         """
         :type keepProbs: Union[int, float, list] 
+        :param cellType: LSTM backend, one of layers.rnn_layer.CELL_TYPES
+        :param packed: if True, a PackedRNNLayer, which skips the padding
         """
 
         if type(keepProbs) in [float, int]:
@@ -24,6 +29,8 @@ class RNNConfig(object):
         self.numCellUnits = numCellUnits
         self.keepProbs = keepProbs
         self.activation = activation
+        self.cellType = cellType
+        self.packed = packed
 
 
 class Mark6(AbstractModel):
@@ -56,7 +63,9 @@ class Mark6(AbstractModel):
         self.print('l2 scheme: ' + l2Scheme)
 
     def make_graph(self):
-        makers = [RNNLayer.new(c.numCellUnits, c.keepProbs, activation=c.activation) for c in self.rnnConfigs]
+        makers = [(PackedRNNLayer if getattr(c, 'packed', False) else RNNLayer)
+                      .new(c.numCellUnits, c.keepProbs, activation=c.activation, cellType=getattr(c, 'cellType', 'basic'))
+                  for c in self.rnnConfigs]
         self.add_layers(makers, self.input, (-1, -1, self.vecDim))
 
         self.add_layers(DropoutLayer.new(self.pooledKeepProb, self.pooledActivation))
@@ -67,6 +76,22 @@ class Mark6(AbstractModel):
             else sum([tf.nn.l2_loss(v) for v in tf.trainable_variables()])
         )
 
+    @classmethod
+    def read_params(cls, filename_):
+        """
+        :param filename_: json of the constructor's parameters, with rnnConfigs as a list of RNNConfig keyword dicts, e.g.
+            {"initialLearningRate": 1e-3, "l2RegLambda": 1e-6, "l2Scheme": "final_stage", "pooledKeepProb": 1,
+             "pooledActivation": null, "rnnConfigs": [{"numCellUnits": [64, 128, 256], "keepProbs": [0.5, 0.6, 0.7]}]}
+        :return: keyword parameters of cls (without input_)
+        """
+
+        with open(filename_, encoding='utf8') as ifile:
+            params = json.load(ifile)
+
+        params['rnnConfigs'] = [RNNConfig(**c) for c in params['rnnConfigs']]
+
+        return params
+
     @classmethod
     def quick_run(cls, runScale ='basic', dataScale='tiny_fake_2', useCPU = True):
 
@@ -181,8 +206,55 @@ class Mark6(AbstractModel):
 
         cls.run_thru_data(EmbeddingDataReader, dataScale, make_params_dict(params), runScale, useCPU)
 
+    @classmethod
+    def benchmark_cell_types(cls, dataScale='full_2occupations', rnnConfigs=None, cellTypes=CELL_TYPES,
+                             batchSize=32, numSteps=20, useCPU=True, packed=(False,)):
+        """
+        training steps per second of each LSTM backend on the same batches, and whether its variables (names and
+        shapes) are those of 'basic', i.e. whether checkpoints can be exchanged
+        :param rnnConfigs: default: one_case's
+        :param packed: run each backend with these values of RNNConfig.packed, e.g. (False, True)
+        :return: { (cell type, packed): (steps per second, same variables as basic) }
+        """
+
+        rnnConfigs = rnnConfigs or [RNNConfig([64, 128, 256], [0.5, 0.6, 0.7]), RNNConfig([64, 64, 64, 64], [0.5, 0.6, 0.7, 0.8])]
+        dataReaderMaker = EmbeddingDataReader.maker_from_premade_source(dataScale)
+
+        def _run(sess, cellType, isPacked):
+            dataReader = dataReaderMaker(bucketingOrRandom='bucketing', batchSize_=batchSize, minimumWords=0)
+            configs = [RNNConfig(c.numCellUnits, c.keepProbs, c.activation, cellType, isPacked) for c in rnnConfigs]
+            model = cls(dataReader.input, 1e-3, 0, 'final_stage', configs, 1, None)
+
+            sess.run(tf.global_variables_initializer())
+            batches = [dataReader.get_next_training_batch()[0] for _ in range(numSteps + 1)]
+            model.train_op(sess, batches[0], False)     # warm up
+
+            startTime = time()
+            for fd in batches[1:]: model.train_op(sess, fd, False)
+
+            return numSteps / (time() - startTime), \
+                   {v.name: v.get_shape().as_list() for v in tf.trainable_variables()}
+
+        res = {}
+        variables = {}
+
+        for cellType in cellTypes:
+            for isPacked in packed:
+                if cellType == 'fused' and isPacked: continue
+
+                key = cellType, isPacked
+                stepsPerSecond, variables[key] = run_with_processor(lambda sess: _run(sess, cellType, isPacked), useCPU)
+                res[key] = stepsPerSecond, variables[key] == variables.get(('basic', False), variables[key])
+
+                print('%-18s %-8s %8.2f steps/sec   same variables as basic: %s'
+                      % (cellType, 'packed' if isPacked else '', *res[key]))
+
+        return res
+
+
 if __name__ == '__main__':
     Mark6.one_case()
+    # Mark6.benchmark_cell_types(packed=(False, True))
     # Mark6.comparison_run()
     # Mark6.quick_run()
     # Mark6.quick_learn()
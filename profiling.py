@@ -0,0 +1,94 @@
+import os
+import re
+from collections import defaultdict
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+GRADIENTS_PREFIX = re.compile(r'^(.*/)?gradients(_\d+)?/')
+
+
+def op_scope(nodeName_):
+    """
+    :return: (scope, is backward pass). Scope is 'layer-i/LayerClass' for ops made in AbstractModel.add_layers,
+             otherwise the top-level name scope (e.g. 'metrics', 'optimizer').
+    """
+
+    name = nodeName_.split(':')[0]
+    isBackward = GRADIENTS_PREFIX.match(name) is not None
+    if isBackward: name = GRADIENTS_PREFIX.sub('', name, count=1)
+
+    parts = name.split('/')
+
+    if parts[0].startswith('layer-') and len(parts) > 2:
+        return '/'.join(parts[:2]), isBackward
+
+    return parts[0], isBackward
+
+
+class StepProfiler(object):
+    """
+    Opt-in FULL_TRACE profiling of some training steps: a Chrome trace per profiled step (open in chrome://tracing)
+    and the time spent per layer scope, forward and backward, over all of them.
+    """
+
+    def __init__(self, outputDir_, logFunc_=None):
+
+        self.outputDir = outputDir_
+        if not os.path.exists(outputDir_): os.makedirs(outputDir_)
+
+        self.print = logFunc_ or print
+        self.runOptions = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        self.numProfiled = 0
+
+        self._micros = defaultdict(lambda: [0, 0])     # { scope: [forward micros, backward micros] }
+
+    def new_run_metadata(self):
+        return tf.RunMetadata()
+
+    def add(self, step_, runMetadata_):
+        """
+        write the step's Chrome trace and add its op times to the per-scope totals
+        """
+
+        trace = timeline.Timeline(runMetadata_.step_stats).generate_chrome_trace_format()
+
+        with open(os.path.join(self.outputDir, 'timeline_step_%d.json' % step_), 'w') as ofile:
+            ofile.write(trace)
+
+        for devStats in runMetadata_.step_stats.dev_stats:
+
+            # GPU ops are reported both per stream and for all streams together
+            if 'stream:' in devStats.device and not devStats.device.endswith('stream:all'): continue
+
+            for nodeStats in devStats.node_stats:
+                scope, isBackward = op_scope(nodeStats.node_name)
+                self._micros[scope][isBackward] += nodeStats.all_end_rel_micros
+
+        self.numProfiled += 1
+
+    def summary(self):
+        """
+        :return: per-scope table of average ms per profiled step, slowest first
+        """
+
+        total = sum(f + b for f, b in self._micros.values()) or 1
+        n = max(self.numProfiled, 1)
+
+        lines = ['%-40s %12s %12s %12s %7s' % ('scope', 'forward ms', 'backward ms', 'total ms', '%')]
+
+        for scope, (f, b) in sorted(self._micros.items(), key=lambda kv: -sum(kv[1])):
+            lines.append('%-40s %12.3f %12.3f %12.3f %6.1f%%' % (scope, f / n / 1e3, b / n / 1e3, (f + b) / n / 1e3, 100. * (f + b) / total))
+
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.numProfiled == 0: return
+
+        res = self.summary()
+
+        with open(os.path.join(self.outputDir, 'layer_summary.txt'), 'w') as ofile:
+            ofile.write(res + '\n')
+
+        self.print('Time per layer scope, averaged over %d profiled steps:\n%s' % (self.numProfiled, res))
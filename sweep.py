@@ -0,0 +1,252 @@
+import os, sys, json
+import sqlite3
+import multiprocessing
+from time import time
+
+import tensorflow as tf
+
+from train import train, RunConfig
+from utilities import run_with_processor
+
+
+SWEEP_RESULTS_DB = '../logs/main/sweep_results.sqlite'
+
+RESULT_COLUMNS = ['validCost', 'validAccuracy', 'testCost', 'testAccuracy', 'numSteps', 'seconds', 'logDir', 'savePath']
+
+
+def params_to_json(params_):
+    # model params hold plain values and config objects like RNNConfig
+    return json.dumps(params_, default=lambda o: {o.__class__.__name__: o.__dict__}, sort_keys=True)
+
+
+class SweepResults(object):
+    """
+    sqlite table of trial results: one row per (model, data, run scale, params), so sweeps can be queried with SQL
+    """
+
+    def __init__(self, dbFilename=SWEEP_RESULTS_DB):
+
+        dbDir = os.path.dirname(dbFilename)
+        if dbDir and not os.path.exists(dbDir): os.makedirs(dbDir)
+
+        self.dbFilename = dbFilename
+        self.conn = sqlite3.connect(dbFilename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS trials ('
+                          'id INTEGER PRIMARY KEY, sweep TEXT, model TEXT, dataScale TEXT, runScale TEXT, params TEXT, '
+                          'validCost REAL, validAccuracy REAL, testCost REAL, testAccuracy REAL, '
+                          'numSteps INTEGER, seconds REAL, logDir TEXT, savePath TEXT, error TEXT, finishedAt REAL)')
+        self.conn.commit()
+
+    def add(self, sweep_, model_, dataScale_, runScale_, params_, results_=None, error_=None):
+        results_ = results_ or {}
+
+        self.conn.execute('INSERT INTO trials (sweep, model, dataScale, runScale, params, %s, error, finishedAt) '
+                          'VALUES (%s)' % (', '.join(RESULT_COLUMNS), ', '.join(['?'] * (len(RESULT_COLUMNS) + 7))),
+                          [sweep_, model_, dataScale_, runScale_, params_to_json(params_)]
+                          + [results_.get(c) for c in RESULT_COLUMNS] + [error_, time()])
+        self.conn.commit()
+
+    def query(self, sql_, *args):
+        """
+        e.g. query('SELECT params, validAccuracy FROM trials WHERE model = ? ORDER BY validAccuracy DESC', 'Mark6')
+        :return: list of rows
+        """
+
+        return self.conn.execute(sql_, args).fetchall()
+
+    def best(self, sweep_=None, n=10, orderBy='validAccuracy DESC, validCost'):
+        """
+        :return: the top n successful trials, of one sweep or of all of them
+        """
+
+        return self.query('SELECT model, params, %s FROM trials WHERE error IS NULL %s ORDER BY %s LIMIT %d'
+                          % (', '.join(RESULT_COLUMNS[:6]), 'AND sweep = ?' if sweep_ else '', orderBy, n),
+                          *([sweep_] if sweep_ else []))
+
+    def close(self):
+        self.conn.close()
+
+
+def _run_trial(trial_):
+    """
+    runs in its own process: a fresh graph and session per trial
+    :return: trial index, results dict (or None), error message (or None)
+    """
+
+    i, modelKlass, dataReaderKlass, dataScale, params, runScale, useCPU, numThreads, gpuMemoryFraction, \
+        logDir, otherDataReaderKwargs, trainKwargs = trial_
+
+    dataReaderMaker = dataReaderKlass.maker_from_premade_source(dataScale, **otherDataReaderKwargs)
+    modelMaker = lambda input_, logFac: modelKlass(input_=input_, **params, loggerFactory_=logFac)
+
+    try:
+        results = run_with_processor(lambda sess: train(sess, dataReaderMaker, modelMaker, runScale, logDir, **trainKwargs),
+                                     useCPU=useCPU, numThreads=numThreads, gpuMemoryFraction=gpuMemoryFraction)
+        return i, results, None
+    except Exception as e:
+        return i, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def _prepare_data(dataReaderKlass, dataScale, runScale, otherDataReaderKwargs):
+    """
+    convert and cache everything the readers need (packed matrices, token ids, the split) before any worker starts,
+    so the trials only read, and memory-map the same files instead of each parsing its own copy
+    """
+
+    dataReaderKlass.prepare_shared_source(dataReaderKlass.premade_sources()[dataScale])
+
+    with tf.Graph().as_default():
+        dataReaderKlass.maker_from_premade_source(dataScale, **otherDataReaderKwargs)(
+            bucketingOrRandom='bucketing', batchSize_=RunConfig(runScale).batchSize, minimumWords=0)
+
+
+def _run_trials(trials_, numParallel_):
+    """
+    :return: generator of (trial index, results, error), in the order they finish
+    """
+
+    # spawn rather than fork: TF does not survive forking. Workers are kept for several trials, so that they
+    # reuse the data readers' prepared batches (see abstract_data_reader._preparedData).
+    with multiprocessing.get_context('spawn').Pool(numParallel_) as pool:
+        for res in pool.imap_unordered(_run_trial, trials_, chunksize=1):
+            yield res
+
+
+def _sweep_id(modelKlass, dataScale, runScale):
+    """
+    :return: sweep name, default log dir
+    """
+
+    sweepId = '%d-%d' % (int(time()), os.getpid())
+
+    return '%s %s %s %s' % (modelKlass.__name__, dataScale, runScale, sweepId), \
+           os.path.join('../logs/main/', modelKlass.__name__, 'sweep-' + sweepId)
+
+
+def _log_trial(trialName_, results_, error_):
+    print('%s %s: %s' % (trialName_, 'failed' if error_ else 'done',
+                         error_ or 'valid cost %0.3f, valid acc %0.3f after %d steps%s'
+                         % (results_['validCost'], results_['validAccuracy'], results_['numSteps'],
+                            ' (stopped early)' if results_['stoppedEarly'] else '')))
+
+
+def run_sweep(modelKlass, dataReaderKlass, dataScale, modelParams, runScale, useCPU=True, numParallel=2,
+              resultsDb=SWEEP_RESULTS_DB, baseLogDir=None, **otherDataReaderKwargs):
+    """
+    Train modelParams' combinations numParallel at a time, each in its own process with its own graph, session and
+    share of the cores (or of the GPU memory). Results go into a SweepResults table.
+    :return: list of (params, results dict or None, error or None), in the order of modelParams
+    """
+
+    assert numParallel > 0
+
+    sweepName, defaultLogDir = _sweep_id(modelKlass, dataScale, runScale)
+    baseLogDir = baseLogDir or defaultLogDir
+
+    _prepare_data(dataReaderKlass, dataScale, runScale, otherDataReaderKwargs)
+
+    numThreads = max(int((multiprocessing.cpu_count() - 1) / numParallel), 1)
+    gpuMemoryFraction = 0.85 / numParallel
+
+    trials = [(i, modelKlass, dataReaderKlass, dataScale, p, runScale, useCPU, numThreads, gpuMemoryFraction,
+               os.path.join(baseLogDir, 'trial-%d' % i), otherDataReaderKwargs, {})
+              for i, p in enumerate(modelParams)]
+
+    print('Sweep %s: %d trials, %d at a time, %d threads each.' % (sweepName, len(trials), numParallel, numThreads))
+
+    table = SweepResults(resultsDb)
+    res = [None] * len(trials)
+
+    for i, results, error in _run_trials(trials, numParallel):
+        res[i] = modelParams[i], results, error
+        table.add(sweepName, modelKlass.__name__, dataScale, runScale, modelParams[i], results, error)
+        _log_trial('Trial %d/%d' % (i + 1, len(trials)), results, error)
+
+    for row in table.best(sweepName, n=5):
+        print(row)
+
+    table.close()
+
+    return res
+
+
+def run_successive_halving(modelKlass, dataReaderKlass, dataScale, modelParams, runScale, useCPU=True, numParallel=1,
+                           eta=3, minSteps=None, resultsDb=SWEEP_RESULTS_DB, baseLogDir=None, **otherDataReaderKwargs):
+    """
+    Successive halving: train every combination for a small step budget, keep the best 1/eta of them by validation
+    accuracy (then cost), and continue the survivors from their checkpoints with eta times the budget, until one is
+    left or the budget reaches runScale's numSteps. Trials that stop early (failToImproveTolerance) are not continued.
+    Only the last rung is evaluated on the test set.
+    :param minSteps: budget of the first rung; if None, numSteps / eta^(number of rungs - 1)
+    :return: list of (params, results of its last rung or None, error or None), in the order of modelParams
+    """
+
+    assert eta > 1
+
+    maxSteps = RunConfig(runScale).numSteps
+    numRungs = 1
+
+    while eta ** numRungs < len(modelParams) and maxSteps / eta ** numRungs >= 1: numRungs += 1
+
+    minSteps = minSteps or max(int(maxSteps / eta ** (numRungs - 1)), 1)
+
+    sweepName, defaultLogDir = _sweep_id(modelKlass, dataScale, runScale)
+    baseLogDir = baseLogDir or defaultLogDir
+
+    _prepare_data(dataReaderKlass, dataScale, runScale, otherDataReaderKwargs)
+
+    numThreads = max(int((multiprocessing.cpu_count() - 1) / numParallel), 1)
+    gpuMemoryFraction = 0.85 / numParallel
+
+    table = SweepResults(resultsDb)
+    res = [(p, None, None) for p in modelParams]
+    survivors = list(range(len(modelParams)))
+    budget = minSteps
+    rung = 0
+
+    while survivors:
+        isLastRung = len(survivors) <= 1 or budget >= maxSteps
+        budget = min(budget, maxSteps)
+
+        print('%s rung %d: %d trials, %d steps each.' % (sweepName, rung, len(survivors), budget))
+
+        trials = []
+
+        for i in survivors:
+            prev = res[i][1]
+            trainKwargs = {'numSteps': budget - (prev['numSteps'] if prev else 0),
+                           'restoreFrom': prev['savePath'] if prev else None,
+                           'startStep': prev['numSteps'] if prev else 0,
+                           'evaluateTest': isLastRung}
+
+            trials.append((i, modelKlass, dataReaderKlass, dataScale, modelParams[i], runScale, useCPU, numThreads,
+                           gpuMemoryFraction, os.path.join(baseLogDir, 'trial-%d' % i, 'rung-%d' % rung),
+                           otherDataReaderKwargs, trainKwargs))
+
+        for i, results, error in _run_trials(trials, numParallel):
+            res[i] = modelParams[i], results or res[i][1], error
+            table.add('%s rung %d' % (sweepName, rung), modelKlass.__name__, dataScale, runScale, modelParams[i], results, error)
+            _log_trial('Rung %d trial %d' % (rung, i), results, error)
+
+        if isLastRung: break
+
+        ranked = sorted((i for i in survivors if res[i][2] is None and not res[i][1]['stoppedEarly']),
+                        key=lambda i: (-res[i][1]['validAccuracy'], res[i][1]['validCost']))
+        survivors = ranked[:max(int(len(survivors) / eta), 1)]
+        budget *= eta
+        rung += 1
+
+    for row in table.query('SELECT sweep, params, validAccuracy, validCost, testAccuracy, numSteps FROM trials '
+                           'WHERE sweep LIKE ? AND error IS NULL ORDER BY validAccuracy DESC, validCost LIMIT 5',
+                           sweepName + ' rung %'):
+        print(row)
+
+    table.close()
+
+    return res
+
+
+if __name__ == '__main__':
+    # usage: python sweep.py [results db]
+    for row in SweepResults(*sys.argv[1:2]).best(n=20):
+        print(row)
@@ -1,12 +1,17 @@
 import os
+import json
 from time import time
 
 os.environ['TF_CPP_MIN_LOG_LEVEL']='1'  # Defaults to 0: all logs; 1: filter out INFO logs; 2: filter out WARNING; 3: filter out errors
 import tensorflow as tf
 
-from utilities import tensorflowFilewriters, label_comparison, LoggerFactory, create_time_dir, dir_create_n_clear
+from profiling import StepProfiler
+from utilities import tensorflowFilewriters, label_comparison, LoggerFactory, create_time_dir, dir_create_n_clear, MetricsRecorder
 
 
+TRAIN_STATE_SUFFIX = '.train_state.json'    # next to each checkpoint: what train needs to carry on from it besides the variables
+MODEL_INFO_SUFFIX = '.model_info.json'      # next to each checkpoint: what serving it needs besides the variables
+
 
 def evaluate_in_batches(sess, batchGenerator_, classLabels_, evaluationFunc_,
                         logFunc_=None, verbose_=True):
@@ -57,10 +62,20 @@ def log_progress(step, numDataPoints, lr, c=None, acc=None, logFunc=None):
     return res
 
 
-def train(sess, dataReaderMaker, modelMaker, runScale, baseLogDir):
+def train(sess, dataReaderMaker, modelMaker, runScale, baseLogDir,
+          numSteps=None, restoreFrom=None, startStep=0, evaluateTest=True, profileEvery=None):
 
     """
     :param dataReaderMaker: lambda 'bucketing', runConfig.batchSize, 40, loggerFactory: dataReader
+    :param numSteps: step budget of this run; if None, runConfig's
+    :param restoreFrom: checkpoint to continue training from (e.g. the savePath of an earlier, shorter run)
+    :param startStep: steps already taken by the restored model, so the learning rate schedule carries on.
+                      The data position, learning rate decay and early stopping state carry on from the checkpoint's
+                      train state, if it has one.
+    :param evaluateTest: if False, skip the test set (e.g. for intermediate runs of a hyperparameter search)
+    :param profileEvery: trace every this many steps (Chrome traces and a per-layer time table in <logDir>/profile);
+                         if None, runConfig's (off by default)
+    :return: dict of the run's results (best validation cost/accuracy, test cost/accuracy, steps, time, where it saved)
     """
 
     assert runScale in RunConfig.available_scales()
@@ -98,67 +113,143 @@ def train(sess, dataReaderMaker, modelMaker, runScale, baseLogDir):
     sess.run(tf.global_variables_initializer())
     saver, savePath = tf.train.Saver(), os.path.join(dir_create_n_clear(logDir, 'saved'), 'save.ckpt')
     trainLogFunc('Saving to ' + savePath)
-    dataReader.start_batch_from_beginning()     # technically unnecessary
-    batchSize, numSteps, logValidationEvery = runConfig.batchSize, runConfig.numSteps, runConfig.logValidationEvery
+
+    isBudgeted = numSteps is not None
+    batchSize, numSteps, logValidationEvery = runConfig.batchSize, numSteps or runConfig.numSteps, runConfig.logValidationEvery
     skipOneValid = False
     bestValidC, bestValidAcc, numValidWorse = 100, 0, 0   # for early stopping if the model isn't getting anywhere :(
     lrDecayPerCycle = 0.9
+    batchIndex = startStep % dataReader.numBatches['train']
 
-    train_accuracies = []
-    lr = initialLr
-
-    for step in range(numSteps):
-        numDataPoints = (step+1) * runConfig.batchSize
-
-        # lr = _decrease_learning_rate(numDataPoints)
-        summaries, c, acc = model.train_op(sess, dataReader.get_next_training_batch()[0], computeMetrics_=True)
-
-        train_writer.add_summary(summaries, step * batchSize)
-        log_progress(step, numDataPoints, lr, c, acc, trainLogFunc)
-        train_accuracies.append(acc)
-
-        if step % logValidationEvery == 0:
-            if skipOneValid:
-                skipOneValid = False
-            else:
-                curValidC, curValidAcc = evaluate_in_batches(sess, dataReader.get_validation_data_in_batches(), dataReader.classLabels, model.evaluate, validLogFunc, verbose_=False)
-                saver.save(sess, savePath, global_step=numDataPoints)
-                avgTrainingAcc = sum(train_accuracies)/len(train_accuracies)
-                train_accuracies = []
-                trainLogFunc('Avg training accuracy = %0.3f' % avgTrainingAcc)
-
-                if curValidC >= bestValidC and curValidAcc <= bestValidAcc:
-                    if numValidWorse >= 2:
-                        lrDecayPerCycle *= 0.8
-
-                    lr = _decrease_learning_rate(numDataPoints)
-                    logValidationEvery = max(int(runConfig.logValidationEvery/3), int(0.8*logValidationEvery))
-                    skipOneValid = True
-
-                    numValidWorse += 1
-                    validLogFunc('Worse than best validation result so far %d time(s). Decreasing lrDecayPerCycle to %0.3f.' % (numValidWorse, lrDecayPerCycle))
-
-                    if numValidWorse >= runConfig.failToImproveTolerance:
-                        validLogFunc('Results have not improved in %d validations. Quitting.' % numValidWorse)
-                        break
-                else:
-                    bestValidC = min(bestValidC, curValidC)
-                    bestValidAcc = max(bestValidAcc, curValidAcc)
-                    numValidWorse = 0
+    if restoreFrom:
+        saver.restore(sess, restoreFrom)
+        trainLogFunc('Restored from %s after %d steps' % (restoreFrom, startStep))
+
+        if os.path.exists(restoreFrom + TRAIN_STATE_SUFFIX):
+            with open(restoreFrom + TRAIN_STATE_SUFFIX, encoding='utf8') as ifile:
+                state = json.load(ifile)
+
+            batchIndex, lrDecayPerCycle, numValidWorse = state['batchIndex'], state['lrDecayPerCycle'], state['numValidWorse']
+            bestValidC, bestValidAcc = state['bestValidC'], state['bestValidAcc']
+            logValidationEvery, skipOneValid = state['logValidationEvery'], state['skipOneValid']
+
+    def _save(globalStep_=None):
+        path = saver.save(sess, savePath, global_step=globalStep_)
+        state = {'batchIndex': dataReader.wherechu_at(), 'lrDecayPerCycle': lrDecayPerCycle, 'numValidWorse': numValidWorse,
+                 'bestValidC': bestValidC, 'bestValidAcc': bestValidAcc,
+                 'logValidationEvery': logValidationEvery, 'skipOneValid': skipOneValid}
 
-                    # obviously overfitting
-                    # if step > 100 and avgTrainingAcc - bestValidAcc > 0.15:
-                    #    trainLogFunc('Overfitting. Quitting...')
-                    #    break
+        info = {'classLabels': list(dataReader.classLabels), 'vecDim': getattr(dataReader, 'vectorDimension', None),
+                'embeddingsKey': getattr(dataReader, 'sourceEmbeddingsKey', None)}
 
+        for suffix, obj in [(TRAIN_STATE_SUFFIX, state), (MODEL_INFO_SUFFIX, info)]:
+            with open(path + suffix + '.tmp', 'w', encoding='utf8') as ofile:
+                json.dump(obj, ofile)
 
-    testLogFunc('Time elapsed: %0.3f ' % (time()-st) )
-    evaluate_in_batches(sess, dataReader.get_test_data_in_batches(), dataReader.classLabels, model.evaluate, testLogFunc, verbose_=True)
+            os.replace(path + suffix + '.tmp', path + suffix)
 
-    saver.save(sess, savePath)
+    dataReader.start_batch_from(batchIndex)
+
+    train_accuracies = []
+    lr = model.lr(sess)
+    stoppedEarly = False
+    # in 'dataset' mode the training batches are already in the graph; nothing to feed
+    trainBatches = None if dataReader.inputMode == 'dataset' else dataReader.prefetch_training_batches(runConfig.prefetchBatches)
+    metrics = MetricsRecorder(os.path.join(logDir, 'metrics.csv'), runConfig.metricsFlushEvery)
+    profileEvery = profileEvery or runConfig.profileEvery
+    profiler = StepProfiler(os.path.join(logDir, 'profile'), trainLogFunc) if profileEvery else None
+
+    try:
+        for step in range(numSteps):
+            numDataPoints = (startStep+step+1) * runConfig.batchSize
+            isSummaryStep = step % runConfig.summaryEvery == 0
+            runMetadata = profiler.new_run_metadata() if profiler is not None and (step + 1) % profileEvery == 0 else None  # step 0 is warm-up
+
+            # lr = _decrease_learning_rate(numDataPoints)
+            stepStart = time()
+            feedDict = next(trainBatches)[0] if trainBatches else {}
+            inputReady = time()
+            summaries, c, acc = model.train_op(sess, feedDict, computeMetrics_=True, computeSummaries_=isSummaryStep,
+                                               runOptions_=profiler.runOptions if runMetadata is not None else None, runMetadata_=runMetadata)
+
+            metrics.record(step=startStep+step, numDataPoints=numDataPoints, lr=lr, cost=c, accuracy=acc,
+                           stepTime=time()-stepStart, inputWaitTime=inputReady-stepStart)
+
+            if isSummaryStep:
+                train_writer.add_summary(summaries, (startStep+step) * batchSize)
+
+            if runMetadata is not None:
+                profiler.add(startStep+step, runMetadata)
+                train_writer.add_run_metadata(runMetadata, 'step%d' % (startStep+step))
+
+            if step % runConfig.logEvery == 0:
+                log_progress(startStep+step, numDataPoints, lr, c, acc, trainLogFunc)
+
+            train_accuracies.append(acc)
+
+            if step % logValidationEvery == 0:
+                if skipOneValid:
+                    skipOneValid = False
+                else:
+                    curValidC, curValidAcc = evaluate_in_batches(sess, dataReader.get_validation_data_in_batches(), dataReader.classLabels, model.evaluate, validLogFunc, verbose_=False)
+                    _save(numDataPoints)
+                    avgTrainingAcc = sum(train_accuracies)/len(train_accuracies)
+                    train_accuracies = []
+                    trainLogFunc('Avg training accuracy = %0.3f' % avgTrainingAcc)
+
+                    if curValidC >= bestValidC and curValidAcc <= bestValidAcc:
+                        if numValidWorse >= 2:
+                            lrDecayPerCycle *= 0.8
+
+                        lr = _decrease_learning_rate(numDataPoints)
+                        logValidationEvery = max(int(runConfig.logValidationEvery/3), int(0.8*logValidationEvery))
+                        skipOneValid = True
+
+                        numValidWorse += 1
+                        validLogFunc('Worse than best validation result so far %d time(s). Decreasing lrDecayPerCycle to %0.3f.' % (numValidWorse, lrDecayPerCycle))
+
+                        if numValidWorse >= runConfig.failToImproveTolerance:
+                            validLogFunc('Results have not improved in %d validations. Quitting.' % numValidWorse)
+                            stoppedEarly = True
+                            break
+                    else:
+                        bestValidC = min(bestValidC, curValidC)
+                        bestValidAcc = max(bestValidAcc, curValidAcc)
+                        numValidWorse = 0
+
+                        # obviously overfitting
+                        # if step > 100 and avgTrainingAcc - bestValidAcc > 0.15:
+                        #    trainLogFunc('Overfitting. Quitting...')
+                        #    break
+
+    finally:
+        metrics.close()
+        if profiler is not None: profiler.close()
+
+        # also on errors, so the thread does not outlive the run; the reader goes back to the last batch trained on
+        if trainBatches: trainBatches.stop()
+
+    if trainBatches: trainLogFunc('Input pipeline: ' + trainBatches.stats())
+
+    # a budgeted run is judged by its validation results, so they have to reflect the last step
+    if isBudgeted and not stoppedEarly and step % logValidationEvery != 0:
+        curValidC, curValidAcc = evaluate_in_batches(sess, dataReader.get_validation_data_in_batches(), dataReader.classLabels, model.evaluate, validLogFunc, verbose_=False)
+        bestValidC = min(bestValidC, curValidC)
+        bestValidAcc = max(bestValidAcc, curValidAcc)
+
+    timeElapsed = time() - st
+    testLogFunc('Time elapsed: %0.3f ' % timeElapsed)
+    testC, testAcc = evaluate_in_batches(sess, dataReader.get_test_data_in_batches(), dataReader.classLabels, model.evaluate, testLogFunc, verbose_=True) \
+        if evaluateTest else (None, None)
+
+    _save()
     train_writer.close()
     valid_writer.close()
 
+    return {'validCost': bestValidC, 'validAccuracy': bestValidAcc, 'testCost': testC, 'testAccuracy': testAcc,
+            'numSteps': startStep + step + 1, 'stoppedEarly': stoppedEarly,
+            'seconds': timeElapsed, 'logDir': logDir, 'savePath': savePath}
+
 
 class RunConfig(object):
     def __init__(self, scale, loggerFactory=None):
@@ -194,12 +285,21 @@ class RunConfig(object):
             self.logValidationEvery = 8
             self.failToImproveTolerance = 6
 
+        self.prefetchBatches = 4    # number of training batches prepared ahead in the background
+
+        # every step's metrics go to metrics.csv in the log dir; the log and the tensorboard summaries are sparser
+        self.logEvery = 1 if scale == 'basic' else 10
+        self.summaryEvery = 1 if scale == 'basic' else 5
+        self.metricsFlushEvery = 100
+        self.profileEvery = 0       # opt-in: trace every this many steps (FULL_TRACE slows those steps down)
+
         self.scale = scale
         self._logFunc = print if loggerFactory is None else loggerFactory.getLogger('config.run').info
         self.print()
 
     def print(self):
         self._logFunc('batch size %d, validation worse run tolerance %d' % (self.batchSize, self.failToImproveTolerance))
+        self._logFunc('log every %d steps, summaries every %d steps' % (self.logEvery, self.summaryEvery))
 
     @classmethod
     def available_scales(cls):
@@ -126,6 +126,58 @@ class LoggerFactory(object):
         return self.loggers[n_]
 
 
+class MetricsRecorder(object):
+    """
+    Collects per-step training metrics in fixed-size column buffers and appends them to a CSV file every flushEvery_
+    records, instead of formatting and writing a log line each step.
+    """
+
+    COLUMNS = ('step', 'numDataPoints', 'lr', 'cost', 'accuracy', 'stepTime', 'inputWaitTime')
+    INTEGER_COLUMNS = ('step', 'numDataPoints')     # written with %d: %.6g would turn 1234567 into 1.23457e+06
+
+    def __init__(self, filename_, flushEvery_=100):
+        assert flushEvery_ > 0
+
+        self.filename = filename_
+        self.flushEvery = flushEvery_
+        self._buffer = np.full((flushEvery_, len(self.COLUMNS)), np.nan)
+        self._numBuffered = 0
+        self._hasHeader = os.path.exists(filename_)
+        self._formats = ['%d' if c in self.INTEGER_COLUMNS else '%.6g' for c in self.COLUMNS]
+
+    def record(self, **values):
+        """
+        :param values: a value for some or all of COLUMNS. Missing ones are written as empty.
+        """
+
+        row = self._buffer[self._numBuffered]
+        row[:] = np.nan
+
+        for k, v in values.items():
+            row[self.COLUMNS.index(k)] = v
+
+        self._numBuffered += 1
+
+        if self._numBuffered == self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        if self._numBuffered == 0: return
+
+        with open(self.filename, 'a', encoding='utf8') as ofile:
+            if not self._hasHeader:
+                ofile.write(','.join(self.COLUMNS) + '\n')
+                self._hasHeader = True
+
+            for row in self._buffer[:self._numBuffered]:
+                ofile.write(','.join('' if np.isnan(v) else f % v for f, v in zip(self._formats, row)) + '\n')
+
+        self._numBuffered = 0
+
+    def close(self):
+        self.flush()
+
+
 def last_relevant(output_, lengths_, numRows_=1):
     batch_size = tf.shape(output_)[0]
     max_length = tf.shape(output_)[1]
@@ -164,29 +216,40 @@ def filter_output_size(inputLen, filterWidth, stride, padding):
 
         return int(np.ceil(inputLen / stride))
 
-def run_with_processor(trainFunc, useCPU):
+def run_with_processor(trainFunc, useCPU, numThreads=None, gpuMemoryFraction=0.85):
     """
     :param trainFunc: lambda sess: train(sess, ...)
+    :param numThreads: CPU threads for TF's thread pools; if None, all cores but one
+    :param gpuMemoryFraction: share of the GPU memory this process may take
     """
 
 
     tf.reset_default_graph()
 
+    # the session is closed afterwards, so that the next run in this process (e.g. the next model of a grid) can reset the graph
     if useCPU:
 
-        numCores = multiprocessing.cpu_count() - 1
+        numCores = numThreads or multiprocessing.cpu_count() - 1
         config = tf.ConfigProto(allow_soft_placement=True,
                                 intra_op_parallelism_threads=numCores,
                                 inter_op_parallelism_threads=numCores)
 
-        with tf.device('/cpu:0'):
+        with tf.device('/cpu:0'):  # the graph is built in trainFunc, so it runs inside the device scope
             sess = tf.InteractiveSession(config=config)
-            return trainFunc(sess)
+
+            try:
+                return trainFunc(sess)
+            finally:
+                sess.close()
     else:
         sess = tf.InteractiveSession(
-            config=tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=0.85),
+            config=tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpuMemoryFraction),
                                   allow_soft_placement=True))
-        return trainFunc(sess)
+
+        try:
+            return trainFunc(sess)
+        finally:
+            sess.close()
 
 def make_params_dict(paramsKeyValuesList):
     """